@@ -15,49 +15,196 @@
 
 from __future__ import division, absolute_import, print_function
 
-import pylast
 from beets import ui
 from beets import config
 from beets import plugins
 from beets.dbcore import types
-import matplotlib.pyplot as plt
-import networkx as nx
+import bisect
+import heapq
+import itertools
+import math
 import os.path
-from networkx.readwrite import json_graph
+import sys
 import json
-import musicbrainzngs
-try:
-    from urllib import quote  # Python 2.X
-except ImportError:
-    from urllib.parse import quote  # Python 3+
-    from urllib.parse import quote_plus
-
-
-try:
-    import pygraphviz
-    from networkx.drawing.nx_agraph import graphviz_layout
-except ImportError:
+import mmap
+import sqlite3
+import struct
+from array import array
+from collections import OrderedDict
+from queue import Empty, Queue
+import threading
+import time
+import unicodedata
+import zlib
+from concurrent import futures
+from contextlib import contextmanager
+from functools import partial, wraps
+from urllib.parse import quote, quote_plus, unquote
+
+# pylast, networkx, musicbrainzngs, matplotlib and Graphviz are imported
+# when the similarity command needs them, and the last.fm client is created on its
+# first request, so loading the plugin does not slow down every ``beet``
+# command.
+LASTFM_CLIENT = None
+_LASTFM_LOCK = threading.Lock()
+
+LASTFM_URL = u'https://ws.audioscrobbler.com/2.0/'
+
+# how the crawl scores an owned artist from the score of the artist that
+# listed it and their similarity match (0..1)
+PRIORITIES = {
+    'product': lambda score, match: score * match,
+    'min': min,
+}
+
+G = None
+
+# orders in which --refresh fetches crawled artists again
+REFRESH_ORDERS = ('stale', 'central')
+
+# a WSError with this status (pylast's STATUS_INVALID_PARAMS) means
+# last.fm does not know the artist
+LASTFM_NOT_FOUND = u'6'
+
+# WSError statuses worth asking again after a while: operation failed,
+# service offline, temporarily unavailable and rate limit exceeded
+LASTFM_TRANSIENT = frozenset([u'8', u'11', u'16', u'29'])
+
+
+def lastfm_client():
+    """Return the pooled last.fm client of the crawl, creating it on
+    first use.
+    """
+    global LASTFM_CLIENT
+    with _LASTFM_LOCK:
+        if LASTFM_CLIENT is None:
+            LASTFM_CLIENT = LastfmClient(
+                config['lastfm']['api_key'].as_str())
+    return LASTFM_CLIENT
+
+
+def lastfm_errors():
+    """Return the pylast exceptions a last.fm request may raise."""
+    import pylast
+    return (pylast.WSError, pylast.MalformedResponseError,
+            pylast.NetworkError)
+
+
+def lastfm_url(name):
+    """Return the last.fm url of the artist called name, built like
+    pylast's ``Artist.get_url`` so stored identities stay the same.
+    """
+    return u'https://www.last.fm/music/' + quote_plus(
+        quote_plus(name)).lower()
+
+
+def shard_of(identity, count):
+    """Return the shard, 1 to count, an artist identity falls in.
+
+    Uses crc32, which unlike ``hash`` is the same in every process.
+    """
+    return zlib.crc32(identity.encode('utf-8')) % count + 1
+
+
+def parse_shard(value):
+    """Parse an ``I/N`` shard option into (I, N)."""
     try:
-        import pydotplus
-        from networkx.drawing.nx_pydot import graphviz_layout
-    except ImportError:
-        raise ImportError("This example needs Graphviz and either "
-                            "PyGraphviz or PyDotPlus")
+        index, count = (int(part) for part in value.split(u'/'))
+    except ValueError:
+        raise ui.UserError(u'--shard needs I/N, not {}'.format(value))
+    if not 1 <= index <= count:
+        raise ui.UserError(u'shard {} is not between 1 and {}'.format(
+            index, count))
+    return index, count
+
+
+def shard_path(jsonfile, shard):
+    """Return the graph file of shard next to jsonfile."""
+    root, ext = os.path.splitext(jsonfile)
+    return u'{}.{}-{}{}'.format(root, shard[0], shard[1], ext)
+
+
+def transient(exc):
+    """Check whether a last.fm error may go away when asked again."""
+    import pylast
+    if isinstance(exc, pylast.WSError):
+        return exc.get_id() in LASTFM_TRANSIENT
+    return isinstance(exc, (pylast.NetworkError,
+                            pylast.MalformedResponseError))
+
+
+def graph():
+    """Return the similarity graph, creating it on first use."""
+    global G
+    if G is None:
+        import networkx as nx
+        G = nx.Graph(program="https://github.com/beetbox/beets")
+    return G
+
+
+def slot_dict(obj):
+    """Return the slots of obj as a dict, for json serialization."""
+    return dict((key, getattr(obj, key)) for key in obj.__slots__)
+
+
+def artist_identity(entry, prefix=u''):
+    """Return the identity of an artist: its mbid or else its last.fm url.
+
+    ``prefix`` selects the ``source_``/``target_`` side of a Relation.
+    """
+    return entry[prefix + 'mbid'] or entry[prefix + 'lastfmurl']
+
+
+def node_attrs(artist):
+    """Return the attributes of the graph node of artist."""
+    return {'mbid': artist['mbid'],
+            'group': artist['group'],
+            'checked': artist['checked'],
+            'name': quote(artist['name']),
+            'lastfmurl': artist['lastfmurl'],
+            'myname': artist['myname'],
+            'fetched': artist['fetched']}
 
-LASTFM = pylast.LastFMNetwork(api_key=plugins.LASTFM_KEY)
 
-PYLAST_EXCEPTIONS = (
-    pylast.WSError,
-    pylast.MalformedResponseError,
-    pylast.NetworkError,
-)
+def relation_attrs(relation):
+    """Return the attributes of the graph edge of relation."""
+    return {'smbid': relation['source_mbid'],
+            'tmbid': relation['target_mbid'],
+            'slastfmurl': relation['source_lastfmurl'],
+            'tlastfmurl': relation['target_lastfmurl'],
+            'rate': relation['rate'],
+            'fetched': relation['fetched']}
 
-G = nx.Graph(program="https://github.com/beetbox/beets")
+
+def first_mbid(items):
+    """Return the album artist mbid of the first item having one."""
+    for item in items:
+        if item['mb_albumartistid']:
+            return item['mb_albumartistid']
+    return None
+
+
+def timed(name):
+    """Decorate a plugin method to be measured by the metrics timer
+    name.
+    """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self._metrics.timer(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorate
 
 
 class SimilarityPlugin(plugins.BeetsPlugin):
     """Determine similarity of artists."""
 
+    # seconds before the first retry of a failed last.fm request
+    RETRY_WAIT = 1.0
+    # records read between two checks of ``max_memory``
+    MEMORY_CHECK = 10000
+
     def __init__(self):
         """Class constructor, initialize things."""
         super(SimilarityPlugin, self).__init__()
@@ -66,17 +213,71 @@ class SimilarityPlugin(plugins.BeetsPlugin):
                               'api_key':  plugins.LASTFM_KEY, })
         config['lastfm']['api_key'].redact = True
 
-        self.config.add({'per_page': 500,
+        self.config.add({'per_page': 10,
                          'retry_limit': 3,
+                         'fail_limit': 3,
                          'json': 'similarity.json',
+                         'format': 'json',
                          'depth': 1,
+                         'rate_policy': 'max',
+                         'checkpoint': 50,
+                         'workers': 4,
+                         'rate_limit': 5,
+                         'priority': 'product',
+                         'max_requests': 0,
+                         'max_seconds': 0,
+                         'musicbrainz_wait': 60,
+                         'cache': 'similarity.cache',
+                         'cache_size': 100000,
+                         'cache_ttl': {'url': 90,
+                                       'similar': 30,
+                                       'mbid': 180,
+                                       'notfound': 7},
+                         'metrics': '',
+                         'drain_on_import': False,
+                         'refresh_budget': 500,
+                         'refresh_order': 'stale',
+                         'host': '127.0.0.1',
+                         'port': 8338,
+                         'viewer': '',
+                         'max_memory': 0,
                          'force': False, })
         self.item_types = {'play_count':  types.INTEGER, }
 
-        self._artistsOwned = list()
-        self._artistsForeign = list()
-        self._relations = list()
-        self._custom_labels = {}
+        self._artistsOwned = ArtistRegistry()
+        self._artistsForeign = ArtistRegistry()
+        self._relations = RelationStore(
+            self.config['rate_policy'].as_choice(RelationStore.POLICIES))
+        self._journal = None
+        self._compact = False
+        self._limiter = RateLimiter(self.config['rate_limit'].as_number())
+        self._requests = 0
+        self._requests_lock = threading.Lock()
+        # (requests, time) when the max_requests/max_seconds budget began
+        self._budget = None
+        self._cache = None
+        self._state = None
+        self._library = None
+        self._resolver = None
+        self._unresolved = {}
+        # similar artists answered along with the url of an owned artist
+        self._prefetched = {}
+        # urls of owned artists looked up by the crawl, not collect
+        self._urls = {}
+        self._metrics = Metrics()
+        self._refresh = False
+        # foreign artists and relations move to a SpillStore at
+        # ``max_memory``
+        self._spill = None
+        self._spillfile = None
+        # (index, count) of a sharded crawl and the seeds of other shards
+        self._shard = None
+        self._elsewhere = set()
+
+        self.register_listener('album_imported', self.imported)
+        self.register_listener('item_imported', self.imported)
+        if self.config['drain_on_import']:
+            self.register_listener('import', self.import_done)
 
     def commands(self):
         """Define the command of plugin and its options and arguments."""
@@ -108,10 +309,137 @@ class SimilarityPlugin(plugins.BeetsPlugin):
             help=u'update data of jsonfile'
         )
 
+        cmd.parser.add_option(
+            u'--max-requests', dest='max_requests', metavar='N',
+            action='store', type='int',
+            help=u'stop the crawl after about N api requests'
+        )
+
+        cmd.parser.add_option(
+            u'--max-seconds', dest='max_seconds', metavar='SECONDS',
+            action='store', type='float',
+            help=u'stop the crawl after SECONDS'
+        )
+
+        cmd.parser.add_option(
+            u'--shard', dest='shard', metavar='I/N',
+            action='store', default=None,
+            help=u'crawl only the I-th of N parts of the seed artists, '
+                 u'into a graph file of its own'
+        )
+
+        cmd.parser.add_option(
+            u'--merge', dest='merge',
+            action='store_true', default=False,
+            help=u'combine the graph files given as arguments into the '
+                 u'graph file'
+        )
+
+        cmd.parser.add_option(
+            u'--resume', dest='resume',
+            action='store_true', default=False,
+            help=u'continue an interrupted crawl where it stopped'
+        )
+
         cmd.parser.add_option(
             u'-c', u'--convert', dest='convert',
             action='store_true', default=False,
-            help=u'convert graph'
+            help=u'convert graph file to the configured format'
+        )
+
+        cmd.parser.add_option(
+            u'--format', dest='format',
+            action='store', choices=GRAPH_FORMATS,
+            help=u'store the graph as json or binary'
+        )
+
+        cmd.parser.add_option(
+            u'-q', u'--query-only', dest='query_only',
+            action='store_true', default=False,
+            help=u'list similar artists from the stored graph only'
+        )
+
+        cmd.parser.add_option(
+            u'-n', u'--top', dest='top', metavar='N',
+            action='store', type='int', default=0,
+            help=u'list only the N most similar owned and not owned artists'
+        )
+
+        cmd.parser.add_option(
+            u'-r', u'--recommend', dest='recommend',
+            action='store_true', default=False,
+            help=u'recommend not owned artists similar to all artists '
+                 u'of the query'
+        )
+
+        cmd.parser.add_option(
+            u'--mode', dest='mode',
+            action='store', choices=Recommender.MODES, default='sum',
+            help=u'score recommendations by summed rate, max rate or '
+                 u'personalized pagerank'
+        )
+
+        cmd.parser.add_option(
+            u'--path', dest='path', metavar='QUERY_A QUERY_B',
+            action='store', nargs=2,
+            help=u'list the strongest connections between the artists of '
+                 u'two queries'
+        )
+
+        cmd.parser.add_option(
+            u'-k', dest='path_k', metavar='K',
+            action='store', type='int', default=3,
+            help=u'list K connections per pair of artists with --path'
+        )
+
+        cmd.parser.add_option(
+            u'--shortest', dest='shortest',
+            action='store_true', default=False,
+            help=u'list the connections with fewest steps with --path'
+        )
+
+        cmd.parser.add_option(
+            u'--export-viz', dest='export_viz', metavar='DIR',
+            action='store',
+            help=u'lay out the stored graph and write level-of-detail '
+                 u'files for the viewer to DIR'
+        )
+
+        cmd.parser.add_option(
+            u'--serve', dest='serve',
+            action='store_true', default=False,
+            help=u'serve the stored graph and the viewer over http'
+        )
+
+        cmd.parser.add_option(
+            u'--refresh', dest='refresh',
+            action='store_true', default=False,
+            help=u'fetch the similar artists of crawled artists again, '
+                 u'stalest first'
+        )
+
+        cmd.parser.add_option(
+            u'--budget', dest='refresh_budget', metavar='N',
+            action='store', type='int',
+            help=u'spend about N api requests on --refresh'
+        )
+
+        cmd.parser.add_option(
+            u'--drain', dest='drain',
+            action='store_true', default=False,
+            help=u'crawl the artists of imports since the last drain'
+        )
+
+        cmd.parser.add_option(
+            u'--stats', dest='stats',
+            action='store_true', default=False,
+            help=u'print timings, request and cache statistics'
+        )
+
+        cmd.parser.add_option(
+            u'--compact', dest='compact',
+            action='store_true', default=False,
+            help=u'rewrite jsonfile and fold in its checkpoint journal'
         )
 
         def func(lib, opts, args):
@@ -121,19 +449,57 @@ class SimilarityPlugin(plugins.BeetsPlugin):
             force = self.config['force']
             update = self.config['update']
             convert = self.config['convert']
+            self._compact = opts.compact
+            if opts.shard:
+                self._shard = parse_shard(opts.shard)
+                jsonfile = shard_path(jsonfile, self._shard)
             if (self.config['depth']):
                 depth = self.config['depth'].get(int)
             else:
                 depth = 0
+
+            if opts.merge:
+                # the arguments are graph files, not a query
+                fullpath = os.path.join(config.config_dir(), jsonfile)
+                self.merge(fullpath, [os.path.join(config.config_dir(), name)
+                                      for name in ui.decargs(args)])
+                self.report_metrics(opts.stats)
+                return
             items = lib.items(ui.decargs(args))
 
-            self.import_similarity(lib, items, jsonfile,
-                                   depth, force, update, convert)
+            if opts.recommend:
+                fullpath = os.path.join(config.config_dir(), jsonfile)
+                self.recommend(fullpath, items, opts.mode, opts.top or 20)
+            elif opts.path:
+                fullpath = os.path.join(config.config_dir(), jsonfile)
+                self.print_paths(fullpath, lib, opts.path, opts.path_k,
+                                 u'shortest' if opts.shortest
+                                 else u'strongest')
+            elif opts.export_viz:
+                fullpath = os.path.join(config.config_dir(), jsonfile)
+                self.export_viz(fullpath, opts.export_viz)
+            elif opts.serve:
+                fullpath = os.path.join(config.config_dir(), jsonfile)
+                self.serve(fullpath)
+            elif opts.refresh:
+                self.refresh(lib, jsonfile)
+            elif opts.drain:
+                self.drain(lib, jsonfile, depth, opts.top)
+            elif opts.query_only:
+                fullpath = os.path.join(config.config_dir(), jsonfile)
+                self.print_similar(self.load_index(fullpath), items,
+                                   opts.top)
+            else:
+                self.import_similarity(lib, items, jsonfile,
+                                       depth, force, update, convert,
+                                       opts.top, opts.resume)
+            self.report_metrics(opts.stats)
 
         cmd.func = func
         return [cmd]
 
-    def import_similarity(self, lib, items, jsonfile, depth, force, update, convert):
+    def import_similarity(self, lib, items, jsonfile, depth, force, update,
+                          convert, top=0, resume=False):
         """
         Import gml-file which contains similarity.
 
@@ -141,80 +507,510 @@ class SimilarityPlugin(plugins.BeetsPlugin):
         """
         fullpath = os.path.join(config.config_dir(), jsonfile)
         self._log.info(u'{}', fullpath)
-        if not force and os.path.isfile(fullpath) and os.access(fullpath,
-                                                                os.R_OK):
+        self._spillfile = fullpath + u'.spill'
+        self._journal = GraphJournal(fullpath + u'.journal')
+        self._cache = self.open_cache()
+        self._state = CrawlState(fullpath + u'.state')
+        compact = self._compact
+        if not force and (os.path.isfile(fullpath) or
+                          self._journal.exists()):
             self._log.info(u'import of json file')
+            compact = compact or convert or self._journal.exists()
             self.import_graph(fullpath)
 
-            if update:
+            if resume:
+                if self._state.finished:
+                    self._log.info(u'last crawl is complete, nothing to '
+                                   u'resume')
+                else:
+                    self._log.info(u'resume crawl: {}',
+                                   self._state.counts())
+                    self.get_similar(lib, self._state.max_depth, resume=True)
+                    compact = True
+            elif update:
                 # create node for each similar artist
                 self.collect_artists(items)
                 # create node for each similar artist
-                self.get_similar(lib, depth, fullpath)
+                self.get_similar(lib, depth)
+                compact = True
         else:
             self._log.info(u'Processing query ... this can take a while')
+            self._journal.remove()
+            self._state.remove()
+            self._state = CrawlState(fullpath + u'.state')
             # create node for each similar artist
             self.collect_artists(items)
             # create node for each similar artist
-            self.get_similar(lib, depth, fullpath)
-        #self.create_graphviz()
-        self.create_graph(lib)
+            self.get_similar(lib, depth)
+            compact = True
+        if compact:
+            self._log.info(u'compact json file')
+            self.save_graph(fullpath)
+            self._journal.remove()
+        self._log.info(u'Crawl state: {}', self._state.counts())
+        self._state.close()
+        self.close_cache()
+        #self.create_graphviz(fullpath + u'.png')
         self._log.info(u'Artist owned: {}', len(self._artistsOwned))
         self._log.info(u'Artist foreign: {}', len(self._artistsForeign))
         self._log.info(u'Relations: {}', len(self._relations))
-        self._log.info(u'Nodes: {}', nx.classes.function.number_of_nodes(G))
-        self._log.info(u'Edges: {}', nx.classes.function.number_of_edges(G))
+        with self._metrics.timer(u'index'):
+            if self._spill is None:
+                G = graph()
+                self._log.info(u'Nodes: {}', G.number_of_nodes())
+                self._log.info(u'Edges: {}', G.number_of_edges())
+                index = SimilarityIndex.from_graph(G)
+            else:
+                index = self.spilled_index(first_mbid(items))
+        self.close_spill()
+        self._log.info(u'Peak RSS: {:.0f} MB', memory_usage()[1])
+        self.print_similar(index, items, top)
 
-        mbid = None
-        for item in items:
-            if item['mb_albumartistid']:
-                mbid = item['mb_albumartistid']
-                break
-        if mbid:
-            for nid, attrs in G.nodes(data=True):
-                if attrs.get('mbid') == mbid :
-                    nl_o = []
-                    nl_f = []
-                    print("Band:", G.nodes[nid]['myname'])
-                    print("Owned:")
-                    for neighbor_id in nx.classes.function.all_neighbors(G, nid):
-                        name = G.nodes[neighbor_id]['myname']
-                        if G.nodes[neighbor_id]['group']==0:
-                            nl_f.append(G[nid][neighbor_id])
-                        else:
-                            nl_o.append(G[nid][neighbor_id])
-                    for n in sorted( nl_o, key= lambda edge: edge['rate'],reverse=True ):
-                        if nid == n['smbid']:
-                            fid = n['tmbid']
-                        else:
-                            fid = n['smbid']
+    def refresh(self, lib, jsonfile):
+        """Fetch the similar artists of crawled owned artists again.
 
-                        print("* {} {}".format(round(n['rate']),G.nodes[fid]['myname']))
-                    print("Not owned:")
-                    for n in sorted( nl_f, key= lambda edge: edge['rate'],reverse=True ):
-                        if nid == n['smbid']:
-                            fid = n['tmbid']
-                        else:
-                            fid = n['smbid']
+        The artists are taken stalest first, or with the most relations
+        first (``refresh_order``), until about ``refresh_budget``
+        requests are spent. New rates replace the stored ones and the
+        graph file is rewritten in place; relations last.fm does not
+        list anymore are kept with their old ``fetched`` time.
+        """
+        fullpath = os.path.join(config.config_dir(), jsonfile)
+        self._journal = GraphJournal(fullpath + u'.journal')
+        if not (os.path.isfile(fullpath) or self._journal.exists()):
+            self._log.info(u'no graph to refresh in {}', fullpath)
+            return
+        self._spillfile = fullpath + u'.spill'
+        self._cache = self.open_cache()
+        self._state = CrawlState(fullpath + u'.refresh')
+        self._state.remove()
+        self._state = CrawlState(fullpath + u'.refresh')
+        self.import_graph(fullpath)
 
-                        print("* {} {}".format(round(n['rate']),G.nodes[fid]['lastfmurl']))
-                    break
+        candidates = [artist for artist in self._artistsOwned
+                      if artist['checked']]
+        if self.config['refresh_order'].as_choice(REFRESH_ORDERS) == \
+                'central':
+            candidates.sort(key=lambda artist: -self.degree(
+                artist_identity(artist)))
+        else:
+            candidates.sort(key=lambda artist: artist['fetched'])
+        for rank, artist in enumerate(candidates):
+            artist['checked'] = False
+            self._state.add(artist_identity(artist), 1,
+                            1.0 - rank / len(candidates))
+
+        self.config['max_requests'] = self.config['refresh_budget'].get(int)
+        policy = self._relations.policy
+        self._relations.policy = 'latest'
+        self._refresh = True
+        try:
+            # owned artists never crawled are left to the next crawl
+            self.get_similar(lib, 1, resume=True, only=set(
+                artist_identity(artist) for artist in candidates))
+        finally:
+            self._refresh = False
+            self._relations.policy = policy
+        refreshed = 0
+        for artist in candidates:
+            if artist['checked']:
+                refreshed += 1
+            else:
+                artist['checked'] = True
+        self._log.info(u'refreshed {} of {} artists', refreshed,
+                       len(candidates))
+
+        self.save_graph(fullpath)
+        self.close_spill()
+        self._journal.remove()
+        self._state.remove()
+        self.close_cache()
+
+    def degree(self, identity):
+        """Return the number of relations of the artist identity."""
+        if self._spill is not None:
+            return self._relations.degree(identity)
+        return graph().degree(identity)
 
+    def check_memory(self):
+        """Spill to disk once the process outgrows ``max_memory``."""
+        limit = self.config['max_memory'].as_number()
+        if not limit or self._spill is not None or not self._spillfile:
+            return
+        current, _ = memory_usage()
+        if current > limit:
+            self._log.info(u'{:.0f} MB resident, moving not owned artists '
+                           u'and relations to {}', current, self._spillfile)
+            self.spill()
 
-    def create_graphviz(self):
-        """Create graph out of collected artists and relations."""
+    def spill(self):
+        """Move the foreign artists and all relations to a SpillStore.
+
+        Only owned artists stay in the graph; from now on foreign
+        artists and relations are written to the store, and
+        ``save_graph`` streams them from there.
+        """
+        store = SpillStore(self._spillfile, self._relations.policy)
+        store.artists.extend(self._artistsForeign)
+        for relation in self._relations:
+            store.relations.upsert(relation)
+        store.flush()
+        G = graph()
+        G.remove_nodes_from(artist_identity(artist)
+                            for artist in self._artistsForeign)
+        G.clear_edges()
+        self._artistsForeign = store.artists
+        self._relations = store.relations
+        self._spill = store
+
+    def close_spill(self):
+        """Delete the SpillStore once the graph file is written.
+
+        The graph then only lives in the file, so the artists and
+        relations kept in memory are dropped as well.
+        """
+        if self._spill is None:
+            return
+        policy = self._relations.policy
+        self._spill.remove()
+        self._spill = None
+        self._artistsOwned.clear()
+        self._artistsForeign = ArtistRegistry()
+        self._relations = RelationStore(policy)
+        graph().clear()
+
+    def spilled_index(self, mbid):
+        """Index the relations of the artist mbid of a spilled crawl,
+        enough for ``print_similar``.
+        """
+        G = graph()
+        links = []
+        nodes = {}
+        for relation in self._relations.around(mbid) if mbid else ():
+            source = artist_identity(relation, u'source_')
+            target = artist_identity(relation, u'target_')
+            links.append(dict(relation_attrs(relation), source=source,
+                              target=target))
+            for nid in (source, target):
+                if nid in G:
+                    nodes[nid] = dict(G.nodes[nid], id=nid)
+                elif nid not in nodes:
+                    nodes[nid] = self._spill.artists.record(nid)
+        return SimilarityIndex.from_records(
+            [record for record in nodes.values() if record], links)
+
+    def close_cache(self):
+        """Close the response cache and log its hit rates."""
+        if not self._cache:
+            return
+        self._cache.close()
+        self._metrics.add_cache(self._cache.stats())
+        for endpoint, hits, misses in self._cache.stats():
+            self._log.info(u'Cache {}: {} hits, {} misses', endpoint,
+                           hits, misses)
+        self._cache = None
+
+    def report_metrics(self, stats):
+        """Print the metrics of this run and append them to the
+        metrics file.
+        """
+        self._metrics.count(u'requests', self._requests)
+        self._metrics.count(u'peak RSS [MB]', round(memory_usage()[1]))
+        if stats:
+            for line in self._metrics.table():
+                print(line)
+        metricsfile = self.config['metrics'].as_str()
+        if metricsfile:
+            self._metrics.write(os.path.join(config.config_dir(),
+                                             metricsfile))
+
+    def import_queue(self):
+        """Return the queue of imported artists next to the graph file."""
+        return ImportQueue(os.path.join(config.config_dir(),
+                                        self.config['json'].as_str()) +
+                           u'.imported')
+
+    def imported(self, lib, album=None, item=None):
+        """Queue the album artist of an imported album or item."""
+        obj = album if album is not None else item
+        if obj['mb_albumartistid']:
+            self.import_queue().add(obj['mb_albumartistid'],
+                                    obj['albumartist'])
+
+    def import_done(self, lib, paths):
+        """Drain the import queue once an import has finished."""
+        depth = self.config['depth'].get(int) if self.config['depth'] else 0
+        self.drain(lib, self.config['json'].as_str(), depth)
+
+    def drain(self, lib, jsonfile, depth, top=0):
+        """Add the artists of the import queue to the graph.
+
+        Only the queued artists are collected, foreign nodes among them
+        promoted to owned, and then crawled like with ``--update``.
+        """
+        queue = self.import_queue()
+        items = queue.items()
+        if not items:
+            self._log.info(u'no imported artists to add')
+            return
+        self._log.info(u'{} imported artists to add', len(items))
+        self.import_similarity(lib, items, jsonfile, depth, False, True,
+                               False, top)
+        queue.clear()
+
+    @timed(u'merge')
+    def merge(self, jsonfile, sources):
+        """Combine the graph files sources, e.g. of the shards of a
+        crawl, into jsonfile.
+
+        Artists are unified like ``ArtistNode.__eq__`` does, an artist
+        owned in any file stays owned and relations of the same pair are
+        kept once with the rate of the ``rate_policy``. The files are
+        read in the given order, so the result only depends on it.
+        """
+        self._spillfile = jsonfile + u'.spill'
+        for source in sources:
+            if not (os.path.isfile(source) or
+                    os.path.isfile(source + u'.journal')):
+                raise ui.UserError(u'no graph file {}'.format(source))
+            nodes, links = self.load_records(source)
+            self._log.info(u'merge {}: {} artists, {} relations', source,
+                           len(nodes), len(links))
+            for count, attrs in enumerate(nodes):
+                if count % self.MEMORY_CHECK == 0:
+                    self.check_memory()
+                if attrs.get('mbid') or attrs.get('lastfmurl'):
+                    self.merge_node(attrs)
+            for count, attrs in enumerate(links):
+                if count % self.MEMORY_CHECK == 0:
+                    self.check_memory()
+                source_mbid, source_url = self.canonical(
+                    attrs['smbid'], attrs['slastfmurl'])
+                target_mbid, target_url = self.canonical(
+                    attrs['tmbid'], attrs['tlastfmurl'])
+                relation = Relation(source_mbid, target_mbid,
+                                    source_url, target_url,
+                                    attrs['rate'], attrs.get('fetched', 0))
+                self.add_graph_edge(self._relations.upsert(relation),
+                                    journal=False)
+        self.save_graph(jsonfile)
+        # a journal left by a crawl into jsonfile would be replayed on
+        # top of the merged graph
+        GraphJournal(jsonfile + u'.journal').remove()
+        self._log.info(u'Artist owned: {}', len(self._artistsOwned))
+        self._log.info(u'Artist foreign: {}', len(self._artistsForeign))
+        self._log.info(u'Relations: {}', len(self._relations))
+        self.close_spill()
+
+    def merge_node(self, attrs):
+        """Add the artist of a node record to the graph or merge it
+        into the stored artist equal to it.
+        """
+        owned = attrs['group'] == 1
+        artistnode = ArtistNode(attrs['mbid'], attrs['id'],
+                                attrs['lastfmurl'], attrs['group'], owned,
+                                attrs['checked'])
+        artistnode['myname'] = attrs['myname'] or "unknown"
+        artistnode['fetched'] = attrs.get('fetched', 0)
+        stored = self._artistsOwned.get(artistnode)
+        if stored is None:
+            stored = self._artistsForeign.get(artistnode)
+        if stored is None:
+            registry = self._artistsOwned if owned else self._artistsForeign
+            registry.append(artistnode)
+            self.add_graph_node(artistnode, journal=False)
+            return
+        if artistnode['mbid'] and not stored['mbid'] and \
+                not stored['owned']:
+            self.set_artist_mbid(stored, artistnode['mbid'])
+        if owned and not stored['owned']:
+            self._artistsForeign.remove(stored)
+            stored['group'] = 1
+            stored['owned'] = True
+            stored['myname'] = artistnode['myname']
+            self._artistsOwned.append(stored)
+        stored['checked'] = stored['checked'] or artistnode['checked']
+        stored['fetched'] = max(stored['fetched'], artistnode['fetched'])
+        self.add_graph_node(stored, journal=False)
+
+    def canonical(self, mbid, lastfmurl):
+        """Return (mbid, lastfmurl) of the stored artist equal to the
+        given one, or the given ones if there is none.
+        """
+        probe = ArtistNode(mbid, u'', lastfmurl)
+        stored = self._artistsOwned.get(probe)
+        if stored is None:
+            stored = self._artistsForeign.get(probe)
+        if stored is None:
+            return mbid, lastfmurl
+        return stored['mbid'], stored['lastfmurl']
+
+    @timed(u'load')
+    def load_records(self, jsonfile):
+        """Read node and link records of the stored graph and journal."""
+        nodes = []
+        links = []
+        if os.path.isfile(jsonfile):
+            _, nodes, links = read_graph_file(jsonfile)
+        GraphJournal(jsonfile + u'.journal').apply(nodes, links)
+        return nodes, links
+
+    def load_index(self, jsonfile):
+        """Index the stored graph and its journal without a crawl."""
+        return SimilarityIndex.from_records(*self.load_records(jsonfile))
+
+    def recommend(self, jsonfile, items, mode, top):
+        """Print the not owned artists most similar to all artists of
+        items.
+        """
+        cachefile = jsonfile + u'.matrix.npz'
+        sources = [jsonfile, jsonfile + u'.journal']
+        recommender = Recommender.load(cachefile, sources)
+        if recommender is None:
+            recommender = Recommender.from_records(
+                *self.load_records(jsonfile))
+            recommender.save(cachefile)
+        seeds = set(item['mb_albumartistid'] for item in items
+                    if item['mb_albumartistid'])
+        found = recommender.positions(seeds)
+        self._log.info(u'Seeds: {} of {} artists in graph', len(found),
+                       len(seeds))
+        for nid, score in recommender.recommend(found, mode, top):
+            print(u'* {:.4g} {}'.format(score, recommender.label(nid)))
+
+    def print_similar(self, index, items, top=0):
+        """Print the artists most similar to the first artist of items."""
+        mbid = first_mbid(items)
+        nid = index.find(mbid) if mbid else None
+        if nid is None:
+            return
+        print("Band:", index.node(nid).get('myname'))
+        print("Owned:")
+        for fid, rate in index.top_similar(nid, top or None, owned=True):
+            print("* {} {}".format(round(rate), index.node(fid).get('myname')))
+        print("Not owned:")
+        for fid, rate in index.top_similar(nid, top or None, owned=False):
+            print("* {} {}".format(round(rate),
+                                   index.node(fid).get('lastfmurl')))
+
+    @timed(u'landmarks')
+    def path_finder(self, jsonfile, index, mode):
+        """Return a PathFinder of index with a cached landmark table."""
+        cachefile = u'{}.landmarks.{}'.format(jsonfile, mode)
+        sources = [jsonfile, jsonfile + u'.journal']
+        table = LandmarkTable.load(cachefile, sources)
+        if table is not None and len(table.ids) != len(index):
+            table = None
+        finder = PathFinder(index, mode, table)
+        if table is None:
+            finder.table.save(cachefile)
+        return finder
+
+    @timed(u'path')
+    def print_paths(self, jsonfile, lib, queries, k, mode):
+        """Print the k best paths between the artists of two queries."""
+        index = self.load_index(jsonfile)
+        finder = self.path_finder(jsonfile, index, mode)
+        ends = []
+        for query in queries:
+            mbids = sorted(set(item['mb_albumartistid'] for item in
+                               lib.items(ui.decargs([query]))
+                               if item['mb_albumartistid']))
+            found = [nid for nid in map(index.find, mbids) if nid]
+            self._log.info(u'{}: {} of {} artists in graph', query,
+                           len(found), len(mbids))
+            ends.append(found)
+
+        def label(nid):
+            attrs = index.node(nid)
+            return attrs.get('myname') or attrs.get('lastfmurl') or nid
+
+        for source in ends[0]:
+            for target in ends[1]:
+                print(u'{} - {}:'.format(label(source), label(target)))
+                found = finder.paths(source, target, k)
+                if not found:
+                    print(u'  not connected')
+                for cost, path in found:
+                    score = len(path) - 1 if mode == u'shortest' else \
+                        1000 * math.exp(-cost)
+                    print(u'* {:.4g} {}'.format(
+                        score, u' > '.join(label(nid) for nid in path)))
+
+    def serve(self, jsonfile):
+        """Serve ego subgraphs and search of the stored graph."""
+        index = self.load_index(jsonfile)
+        version = u' '.join(
+            str(os.path.getmtime(path)) for path in
+            (jsonfile, jsonfile + u'.journal') if os.path.isfile(path))
+        root = self.config['viewer'].as_str()
+        if not root:
+            # the viewer of a source checkout
+            root = os.path.join(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))), u'graph')
+        server = SimilarityServer(index, version,
+                                  root if os.path.isdir(root) else None)
+        server.serve(self.config['host'].as_str(),
+                     self.config['port'].get(int), self._log)
+
+    @timed(u'layout')
+    def export_viz(self, jsonfile, directory):
+        """Write the stored graph with node positions to directory."""
+        nodes, links = self.load_records(jsonfile)
+        if not nodes:
+            self._log.info(u'no graph to export in {}', jsonfile)
+            return
+        layout = GraphLayout.from_records(nodes, links)
+        positions = layout.layout(GraphLayout.read_positions(directory))
+        for level, counts in enumerate(layout.write(directory, positions)):
+            self._log.info(u'level {}: {} artists, {} relations', level,
+                           counts['nodes'], counts['links'])
+
+    def create_graphviz(self, path):
+        """Render the collected artists and relations as image to path,
+        owned artists in another color than not owned ones.
+        """
+        # rendering needs the optional graphviz extra
+        try:
+            import matplotlib.pyplot as plt
+            import networkx as nx
+            try:
+                import pygraphviz  # noqa: F401
+                from networkx.drawing.nx_agraph import graphviz_layout
+            except ImportError:
+                import pydotplus  # noqa: F401
+                from networkx.drawing.nx_pydot import graphviz_layout
+        except ImportError:
+            raise ui.UserError(u'rendering needs matplotlib, Graphviz and '
+                               u'either PyGraphviz or PyDotPlus')
+        G = graph()
         plt.figure(figsize=(6,8))
         pos=graphviz_layout(G)
-        nx.draw_networkx_nodes(G,pos,nodelist=G.nodes(),node_size=5, linewidths=0.1,vmin=0,vmax=1,alpha=0.8, node_color=[D[n] for n in G.nodes()])
+        nx.draw_networkx_nodes(G,pos,nodelist=G.nodes(),node_size=5, linewidths=0.1,vmin=0,vmax=1,alpha=0.8, node_color=[G.nodes[n].get('group', 0) for n in G.nodes()])
         nx.draw_networkx_edges(G,pos,edgelist=G.edges(),width=0.1, edge_color="black",alpha=0.6)
         plt.axis('off')
         plt.tight_layout()
-        plt.savefig("lanl_routes.png")
+        plt.savefig(path)
+        plt.close()
 
+    @timed(u'collect')
     def collect_artists(self, items):
-        """Collect artists from query."""
+        """Collect artists from query.
 
+        Looking up the url of a new artist is a request, which counts
+        against the budget of the crawl that follows. Once it is spent
+        the artists are collected without url; the crawl looks it up
+        when it expands them.
+        """
+        self.start_budget()
+        newartists = ArtistRegistry()
         for item in items:
+            if self._shard and item['mb_albumartistid'] and shard_of(
+                    item['mb_albumartistid'],
+                    self._shard[1]) != self._shard[0]:
+                # crawled by the shard it falls in
+                self._elsewhere.add(item['mb_albumartistid'])
+                continue
             if item['mb_albumartistid']:
                 artistnode = ArtistNode(item['mb_albumartistid'],
                                         item['albumartist'],
@@ -223,309 +1019,2807 @@ class SimilarityPlugin(plugins.BeetsPlugin):
                 artistnode['group'] = 1
                 artistnode['owned'] = True
                 artistnode['myname'] = item['albumartist']
-                if artistnode not in self._artistsOwned:
-                    lastfmurl = u''
-                    try:
+                if (artistnode in self._artistsOwned or
+                        artistnode in newartists):
+                    continue
+                foreign = self._artistsForeign.get(artistnode)
+                if foreign is not None:
+                    self.promote(foreign, item['albumartist'])
+                else:
+                    newartists.append(artistnode)
+
+        def lookup(artist):
+            if self.budget_spent():
+                return u''
+            return self.fetch_url(artist)
 
-                        lastfm_artist = LASTFM.get_artist_by_mbid(
-                            item['mb_albumartistid'])
-                        lastfmurl = lastfm_artist.get_url()
-                    except PYLAST_EXCEPTIONS as exc:
-                        try:
-                            lastfm_artist = LASTFM.get_artist(
-                                quote(item['albumartist']))
-                            lastfmurl = lastfm_artist.get_url()
-                        except PYLAST_EXCEPTIONS as exc:
-                            self._log.debug(u'1 last.fm error: {0}', exc)
-
-                    artistnode['lastfmurl'] = lastfmurl
-                    self._log.debug(
-                        u'collect: {}', artistnode)
-                    self._artistsOwned.append(artistnode)
+        for artistnode, lastfmurl in self.fetch_ordered(lookup, newartists):
+            artistnode['lastfmurl'] = lastfmurl
+            self._log.debug(
+                u'collect: {}', artistnode)
+            # last.fm may have listed it without mbid before
+            foreign = self._artistsForeign.get(artistnode)
+            if foreign is not None:
+                if not foreign['mbid']:
+                    self.set_artist_mbid(foreign, artistnode['mbid'])
+                self.promote(foreign, artistnode['myname'])
+                continue
+            self._artistsOwned.append(artistnode)
+            self.add_graph_node(artistnode)
         return
 
-    def get_similar(self, lib, depth, fullpath):
-        """Collect artists from query."""
-        depthcounter = 1
+    def promote(self, artist, name):
+        """Turn a foreign artist the library now owns into an owned one.
 
-        while True:
-            havechilds = False
-            self._log.info(u'Level: {}-{}', depthcounter, depth)
+        The node keeps its id and edges, so the crawl only has to expand
+        it.
+        """
+        self._artistsForeign.remove(artist)
+        artist['group'] = 1
+        artist['owned'] = True
+        artist['checked'] = False
+        artist['myname'] = name
+        self._artistsOwned.append(artist)
+        self.add_graph_node(artist)
+        self._log.info(u'now owned: {}', name)
 
-            if not depth == 0 and depthcounter > depth:
-                self._log.info(u'out!')
-                break
-            depthcounter += 1
-            artistsshadow = list()
-            for artist in self._artistsOwned:
-                if not artist['checked']:
-                    self._log.debug(u'Artist: {}-{}', artist['mbid'],
-                                   artist['lastfmurl'])
-                    try:
-                        lastfm_artist = LASTFM.get_artist_by_mbid(
-                            artist['mbid'])
-                    except PYLAST_EXCEPTIONS as exc:
-                        try:
-                            self._log.info(u'last.fm error: {0}', exc)
-
-                            val=lib.items('mb_albumartistid:' + quote(artist['mbid']))
-                            valtmp = val[0]['artist']
-                            #valtmp = quote_plus(valtmp)
-                            #print(valtmp)                            
-                            lastfm_artist = LASTFM.get_artist(valtmp)
-                        except PYLAST_EXCEPTIONS as exc:
-                            self._log.info(u'2 last.fm error: {0}', exc)
-                            continue
-                    try:
-                        similar_artists = lastfm_artist.get_similar(10)
-                        artist['checked'] = True
-                    except pylast.WSError as exc:
-                        similar_artists = []
-                        artist['checked'] = False
-                        self._log.info(u'2 last.fm error: {0}', exc)
-
-
-                    for artistinfo in similar_artists:
-                        mbid = artistinfo[0].get_mbid()
-                        name = artistinfo[0].get_name()
-                        lastfmurl = artistinfo[0].get_url()
-                        #print("sim artists:",lastfmurl," ",mbid)
-
-                        if name:
-                            artistnode = ArtistNode(mbid, quote(name), lastfmurl)
-                            if len(lib.items('artist:' + name)) > 0:
-                                if ((artistnode not in
-                                     self._artistsOwned) and
-                                    (artistnode not in
-                                     artistsshadow)):
-                                    artistnode['group'] = 1
-                                    artistnode['myname'] = name
-                                    artistnode['owned'] = True
-
-                                    artistsshadow.append(artistnode)
-                                    self._log.info(u'I own this: {}', name)
-                                    havechilds = True
-                            else:
-                                if artistnode not in self._artistsForeign:
-                                    if not mbid:
-                                        result = musicbrainzngs.search_artists(artist=name)
-
-                                        for artist_mb in result['artist-list']:
-                                            #print(u"{id}: {name}".format(id=artist_mb['id'], name=artist_mb["name"]))
-                                            mbid=artist_mb['id']
-                                            artistnode['mbid']=mbid
-                                            break
-
-                                    artistnode['group'] = 0
-                                    artistnode['myname'] = name
-                                    artistnode['owned'] = False
-                                    self._artistsForeign.append(artistnode)
-
-                            relation = Relation(artist['mbid'],
-                                                mbid,
-                                                artist['lastfmurl'],
-                                                lastfmurl,
-                                                artistinfo[1] * 1000)
-
-                            # if relation not in _relations:
-                            self._relations.append(relation)
-                    
-
-            self._artistsOwned.extend(artistsshadow)
-            del artistsshadow[:]
-            self.create_graph(lib)
-            self.save_graph(fullpath)
-            if not havechilds:
-                break
-            
+    @timed(u'crawl')
+    def get_similar(self, lib, depth, resume=False, only=None):
+        """Collect artists from query.
 
-    def save_graph(self, jsonfile):
-        h = nx.relabel_nodes(G, self._custom_labels)
-
-        data = json_graph.node_link_data(h)
-        with open(jsonfile, 'w') as fp:
-            json.dump(data, fp, indent=4, sort_keys=True)
-
-    def create_graph(self, lib):
-        """Create graph out of collected artists and relations."""
-        G.clear()
-        self._custom_labels = {}
-        for owned_artist in self._artistsOwned:
-            self._custom_labels[owned_artist['mbid']] = owned_artist['mbid']
-            G.add_node(owned_artist['mbid'],
-                       mbid=owned_artist['mbid'],
-                       group=owned_artist['group'],
-                       checked=owned_artist['checked'],
-                       name=quote(owned_artist['name']),
-                       lastfmurl=owned_artist['lastfmurl'],
-                       myname=owned_artist['myname']
-                       )
-            
-            self._log.debug(u'#{}', owned_artist['mbid'])
-
-        for foreign_artist in self._artistsForeign:
-            if foreign_artist not in self._artistsOwned:
-                self._custom_labels[foreign_artist['mbid']] = foreign_artist['mbid']
-                G.add_node(foreign_artist['mbid'],
-                           mbid=foreign_artist['mbid'],
-                           group=foreign_artist['group'],
-                           checked=foreign_artist['checked'],
-                           name=quote(foreign_artist['name']),
-                           lastfmurl=foreign_artist['lastfmurl'],
-                           myname=foreign_artist['myname'])
-                self._log.debug(u'#{}', foreign_artist['mbid'])
+        Expands owned artists best first: every artist has a score, 1
+        for the seeds and for a newly found owned artist the score of
+        the artist that listed it combined with their similarity (see
+        the ``priority`` option). Artists more than ``depth`` levels
+        away from the seeds are not expanded, and the crawl stops once
+        the ``max_requests`` or ``max_seconds`` budget is spent.
+        Progress is kept in the crawl state, so with ``resume`` the
+        crawl continues with the artists an interrupted or budgeted run
+        left behind. If only is a set of artist identities, just these
+        artists are expanded and no artist they list is queued.
+        """
+        if self._library is None:
+            with self._metrics.timer(u'library'):
+                self._library = LibraryIndex(lib)
+        state = self._state
+        fail_limit = self.config['fail_limit'].get(int)
+        if not resume:
+            state.start(depth)
+        checkpoint = self.config['checkpoint'].get(int)
+        combine = self.config['priority'].as_choice(PRIORITIES)
+        batch = max(1, self.config['workers'].get(int))
+        if self._budget is None:
+            self.start_budget()
+        expanded = 0
 
-        for relation in self._relations:
-            G.add_edge(relation['source_mbid'],
-                       relation['target_mbid'],
-                       smbid=relation['source_mbid'],
-                       tmbid=relation['target_mbid'],
-                       slastfmurl=relation['source_lastfmurl'],
-                       tlastfmurl=relation['target_lastfmurl'],
-                       rate=relation['rate'],
-                       )
-            self._log.debug(u'{}#{}', relation['source_mbid'],
-                            relation['target_mbid'])
+        self._resolver = MbidResolver(self.search_mbid, self._cache,
+                                      self._log)
+        for artist in self._artistsForeign:
+            if not artist['mbid']:
+                self.resolve_later(artist)
 
-    def import_graph(self, jsonfile):
-        """Import graph from previous created gml file."""
-        with open(jsonfile) as data_file:
-            data = json.load(data_file)
+        queue = CrawlQueue()
+        for artist in self._artistsOwned:
+            identity = artist_identity(artist)
+            if not artist['checked'] and state.runnable(identity) and (
+                    only is None or identity in only):
+                level, score = state.position(identity)
+                queue.push(artist, level, score)
 
-        i = json_graph.node_link_graph(data)
+        while True:
+            spent = self.budget_spent()
+            if spent:
+                self._log.info(u'{} budget spent, {} artists left', spent,
+                               len(queue))
+                break
+            self.apply_resolved()
+            frontier = []
+            while len(frontier) < batch:
+                entry = queue.pop()
+                if entry is None:
+                    break
+                if depth == 0 or entry[1] <= depth:
+                    frontier.append(entry)
+            if not frontier:
+                state.finish()
+                break
+            self._log.debug(u'Expand: {} artists, best score {}',
+                            len(frontier), frontier[0][2])
 
-        for artist in i.nodes(data=True):
+            results = self.fetch_ordered(self.fetch_similar,
+                                         [entry[0] for entry in frontier])
+            for (artist, level, score), (_, similar_artists) in zip(
+                    frontier, results):
+                if similar_artists is None:
+                    if state.fail(artist_identity(artist), fail_limit):
+                        self._log.info(u'giving up on {}', artist['myname'])
+                    else:
+                        queue.push(artist, level, score)
+                    continue
+                fetched = int(time.time())
+                lastfmurl = self._urls.pop(artist_identity(artist), None)
+                if lastfmurl:
+                    self._artistsOwned.set_lastfmurl(artist, lastfmurl)
+                artist['checked'] = True
+                artist['fetched'] = fetched
+                state.done(artist_identity(artist))
+                self.add_graph_node(artist)
 
-            self._log.debug(u'{}', artist)
-            if artist[1].get('mbid'):
-                if artist[1]['group'] == 1:
-                    artist[1]['owned'] = True
-                else:
-                    artist[1]['owned'] = False
-                
-                artistnode = ArtistNode(artist[1]['mbid'], artist[0],
-                                        artist[1]['lastfmurl'],
-                                        artist[1]['group'],
-                                        artist[1]['owned'],
-                                        artist[1]['checked'])
-                artistnode['myname'] = artist[1]['myname']
-                if artist[1]['myname']=="":
-                    artistnode['myname'] = "unknown"
-                   
-                if artist[1]['group'] == 1:
-                    if artistnode not in self._artistsOwned:
-                        self._artistsOwned.append(artistnode)
-                else:
-                    if artistnode not in self._artistsForeign:
-                        self._artistsForeign.append(artistnode)
-        for relitem in i.edges(data=True):
-            if not relitem[2]['tmbid']:
-                relitem[2]['tmbid']=relitem[1]
+                for mbid, name, lastfmurl, match in similar_artists:
+                    #print("sim artists:",lastfmurl," ",mbid)
 
-            relation = Relation(relitem[2]['smbid'],
-                                relitem[2]['tmbid'],
-                                relitem[2]['slastfmurl'],
-                                relitem[2]['tlastfmurl'],
-                                relitem[2]['rate'])
-            self._relations.append(relation)
+                    if name:
+                        artistnode = ArtistNode(mbid, quote(name), lastfmurl)
+                        if self._library.owns(name):
+                            known = self._artistsOwned.get(artistnode)
+                            if known is None:
+                                known = self._artistsForeign.get(artistnode)
+                                if known is not None:
+                                    self.promote(known, name)
+                            if known is None:
+                                known = artistnode
+                                artistnode['group'] = 1
+                                artistnode['myname'] = name
+                                artistnode['owned'] = True
 
+                                self._artistsOwned.append(artistnode)
+                                # journaled right away, so a resumed
+                                # crawl finds it queued
+                                self.add_graph_node(artistnode)
+                                self._log.info(u'I own this: {}', name)
+                            if not known['checked'] and only is None and (
+                                    depth == 0 or level < depth) and \
+                                    artist_identity(known) not in \
+                                    self._elsewhere:
+                                child = combine(score, match)
+                                state.add(artist_identity(known), level + 1,
+                                          child)
+                                queue.push(known, level + 1, child)
+                        else:
+                            known = self._artistsForeign.get(artistnode)
+                            if known is None:
+                                known = artistnode
+                                artistnode['group'] = 0
+                                artistnode['myname'] = name
+                                artistnode['owned'] = False
+                                self._artistsForeign.append(artistnode)
+                                self.add_graph_node(artistnode)
+                                if not mbid:
+                                    self.resolve_later(artistnode)
 
-class Relation():
-    """Relations between Artists."""
+                        # refer to the stored node, which may carry an
+                        # mbid last.fm does not know about
+                        relation = Relation(artist['mbid'],
+                                            known['mbid'],
+                                            artist['lastfmurl'],
+                                            known['lastfmurl'],
+                                            match * 1000,
+                                            fetched)
 
-    def __init__(self, source_mbid, target_mbid, source_lastfmurl,
-                 target_lastfmurl, rate):
-        """Constructor of class."""
-        self.source_mbid = source_mbid
-        self.target_mbid = target_mbid
-        self.source_lastfmurl = source_lastfmurl
-        self.target_lastfmurl = target_lastfmurl
-        self.rate = rate
+                        self.add_graph_edge(
+                            self._relations.upsert(relation))
 
-    def __eq__(self, other):
-        """Override the default Equals behavior."""
-        s = False
-        t = False
-        st = False
+                expanded += 1
+                if checkpoint and expanded % checkpoint == 0:
+                    self.checkpoint()
+        left = self._resolver.close(
+            self.config['musicbrainz_wait'].as_number())
+        self.apply_resolved()
+        if left:
+            self._log.info(u'{} artists still without mbid', left)
+        self._resolver = None
+        self._unresolved.clear()
+        self._prefetched.clear()
+        self._urls.clear()
+        self._budget = None
+        self.checkpoint()
 
-        if isinstance(other, self.__class__):
+    @timed(u'checkpoint')
+    def checkpoint(self):
+        """Persist journal, crawl state and cache."""
+        self._journal.flush()
+        self._state.flush()
+        if self._cache:
+            self._cache.flush()
+        if self._spill is not None:
+            self._spill.flush()
+        self.check_memory()
 
-            if self.source_mbid and other.source_mbid:
-                if self.source_mbid == other.source_mbid:
-                    s = True
-            else:
-                if self.source_lastfmurl and other.source_lastfmurl:
-                    if self.source_lastfmurl == other.source_lastfmurl:
-                        s = True
+    def fetch_ordered(self, func, artists):
+        """Apply func to artists on the worker pool.
 
-            if self.target_mbid and other.target_mbid:
-                if self.target_mbid == other.target_mbid:
-                    t = True
-            else:
-                if self.target_lastfmurl and other.target_lastfmurl:
-                    if self.target_lastfmurl == other.target_lastfmurl:
-                        t = True
+        Yields (artist, result) pairs in the order of artists, whatever
+        order the requests finish in, so merging stays deterministic.
+        """
+        workers = self.config['workers'].get(int)
+        if workers < 2:
+            for artist in artists:
+                yield artist, func(artist)
+            return
+        artists = list(artists)
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for artist, result in zip(artists, pool.map(func, artists)):
+                yield artist, result
 
-            if self.source_mbid and other.target_mbid:
-                if self.source_mbid == other.target_mbid:
-                    st = True
-            else:
-                if self.source_lastfmurl and other.target_lastfmurl:
-                    if self.source_lastfmurl == other.target_lastfmurl:
-                        st = True
+    def lastfm_call(self, func, *args):
+        """Call the last.fm api once the rate limiter allows it.
 
-            if self.target_mbid and other.source_mbid:
-                if self.target_mbid == other.source_mbid:
-                    st = True
-            else:
-                if self.target_lastfmurl and other.source_lastfmurl:
-                    if self.target_lastfmurl == other.source_lastfmurl:
-                        st = True
+        A transient failure is retried up to ``retry_limit`` times,
+        waiting twice as long before every attempt.
+        """
+        retries = self.config['retry_limit'].get(int)
+        for attempt in itertools.count():
+            self._limiter.acquire()
+            self.count_request()
+            with self._metrics.timer(u'lastfm'):
+                try:
+                    return func(*args)
+                except lastfm_errors() as exc:
+                    self._metrics.error(u'lastfm', exc)
+                    if attempt >= retries or not transient(exc):
+                        raise
+            time.sleep(self.RETRY_WAIT * 2 ** attempt)
 
-        if s and t or st:
-            return True
-        else:
-            return False
+    def start_budget(self):
+        """Count requests and time against max_requests and max_seconds
+        from now on.
+        """
+        self._budget = (self._requests, time.monotonic())
 
-    def __ne__(self, other):
-        """Define a non-equality test."""
-        if isinstance(other, self.__class__):
-            return not self.__eq__(other)
+    def budget_spent(self):
+        """Return u'request' or u'time' once the budget is spent, else
+        None.
+        """
+        if self._budget is None:
+            return None
+        requests, started = self._budget
+        max_requests = self.config['max_requests'].get(int)
+        max_seconds = self.config['max_seconds'].as_number()
+        if max_requests and self._requests - requests >= max_requests:
+            return u'request'
+        if max_seconds and time.monotonic() - started >= max_seconds:
+            return u'time'
+        return None
 
-    def __getitem__(self, key):
-        """Define a getitem function."""
-        if key == 'source_mbid':
-            return self.source_mbid
-        elif key == 'target_mbid':
-            return self.target_mbid
-        elif key == 'rate':
-            return self.rate
-        elif key == 'source_lastfmurl':
-            return self.source_lastfmurl
-        elif key == 'target_lastfmurl':
-            return self.target_lastfmurl
-        else:
+    def count_request(self):
+        """Count a request against the crawl budget."""
+        with self._requests_lock:
+            self._requests += 1
+
+    def open_cache(self):
+        """Open the response cache configured by the cache options."""
+        cachefile = self.config['cache'].as_str()
+        if not cachefile:
             return None
+        ttl = self.config['cache_ttl']
+        return ResponseCache(os.path.join(config.config_dir(), cachefile),
+                             self.config['cache_size'].get(int),
+                             dict((key, ttl[key].as_number() * 86400)
+                                  for key in ttl.keys()))
 
-    def tojson(self):
-        """Define a setitem function."""
-        return json.dumps(self, default=lambda o: o.__dict__,
-                          sort_keys=True, indent=4)
+    def cached(self, endpoint, key, func):
+        """Answer func() from the response cache or store its result.
 
+        func returns the response, or raises WSError; a "not found" error
+        is cached as None and reraised on later hits.
+        """
+        import pylast
+        # a refresh asks again but keeps the new answer
+        if self._cache and not self._refresh:
+            hit, value = self._cache.get(endpoint, key)
+            if hit:
+                if value is None:
+                    raise pylast.WSError(None, LASTFM_NOT_FOUND,
+                                         u'cached: not found')
+                return value
+        try:
+            value = func()
+        except pylast.WSError as exc:
+            if self._cache and exc.get_id() == LASTFM_NOT_FOUND:
+                self._cache.put(endpoint, key, None)
+            raise
+        if self._cache:
+            self._cache.put(endpoint, key, value)
+        return value
 
-class ArtistNode():
-    """Artist Nodes."""
+    def fetch_url(self, artist):
+        """Look up the last.fm url of an owned artist."""
+        try:
+            return self.cached(u'url', artist['mbid'],
+                               partial(self.request_url, artist))
+        except lastfm_errors() as exc:
+            self._log.debug(u'1 last.fm error: {0}', exc)
+        return u''
 
-    mbid = u''
-    name = u''
-    lastfmurl = u''
-    owned = False
-    checked = False
-    group = 0
-    myname = u'unknown'
+    def request_url(self, artist):
+        """Ask last.fm for the url of artist.
 
-    def __init__(self, mbid, name, lastfmurl, group=0, owned=False,
-                 checked=False):
+        The similar artists come with the same answer and are kept for
+        the crawl, so expanding the artist needs no request of its own.
+        """
+        url, similar = self.request_artist(artist)
+        identity = artist_identity(artist)
+        self._prefetched[identity] = similar
+        if self._cache:
+            self._cache.put(u'similar', self.similar_key(artist), similar)
+        return url
+
+    def fetch_similar(self, artist):
+        """Fetch the similar artists of artist from last.fm.
+
+        Runs on the worker pool and must not touch the graph. Returns a
+        list of (mbid, name, lastfmurl, match) tuples, or None if last.fm
+        could not answer.
+        """
+        self._log.debug(u'Artist: {}-{}', artist['mbid'],
+                        artist['lastfmurl'])
+        identity = artist_identity(artist)
+        fresh = False
+        if artist['mbid'] and not artist['lastfmurl']:
+            # collected after the budget was spent; the same request
+            # answers the url and the similar artists
+            lastfmurl = self.fetch_url(artist)
+            if lastfmurl:
+                self._urls[identity] = lastfmurl
+                fresh = True
+        similar = self._prefetched.pop(identity, None)
+        if similar is not None and (fresh or not self._refresh):
+            return [tuple(entry) for entry in similar]
+        try:
+            similar = self.cached(u'similar', self.similar_key(artist),
+                                  partial(self.request_similar, artist))
+        except lastfm_errors() as exc:
+            self._log.info(u'2 last.fm error: {0}', exc)
+            return None
+        return [tuple(entry) for entry in similar]
+
+    def similar_key(self, artist):
+        """Return the cache key of the similar artists of artist.
+
+        Includes ``per_page``, so answers cut to another length are not
+        used.
+        """
+        return u'{} {}'.format(artist_identity(artist),
+                               self.config['per_page'].get(int))
+
+    def request_similar(self, artist):
+        """Ask last.fm for the similar artists of artist."""
+        return self.request_artist(artist)[1]
+
+    def request_artist(self, artist):
+        """Ask last.fm for (url, similar artists) of artist.
+
+        Asks by mbid and, if last.fm does not know it, by name; the
+        similar artists come with their mbid and url, so this is one
+        request for most artists. ``per_page`` limits their number.
+        """
+        import pylast
+        client = lastfm_client()
+        limit = self.config['per_page'].get(int)
+        if artist['mbid']:
+            try:
+                return self.lastfm_call(client.similar, limit,
+                                        artist['mbid'])
+            except pylast.WSError as exc:
+                if exc.get_id() != LASTFM_NOT_FOUND:
+                    raise
+                self._log.debug(u'last.fm does not know mbid {}',
+                                artist['mbid'])
+        name = artist['myname']
+        if self._library is not None:
+            name = self._library.name(artist['mbid']) or name
+        if not name:
+            raise pylast.WSError(None, LASTFM_NOT_FOUND, u'no name')
+        return self.lastfm_call(client.similar, limit, None, name)
+
+    def search_mbid(self, name):
+        """Look up the mbid of an artist by name on MusicBrainz.
+
+        Returns the mbid of the first hit or u'' if there is none.
+        Runs on the resolver thread; musicbrainzngs keeps to the
+        MusicBrainz rate limit of one request per second.
+        """
+        import musicbrainzngs
+        self.count_request()
+        with self._metrics.timer(u'musicbrainz'):
+            try:
+                result = musicbrainzngs.search_artists(artist=name)
+            except musicbrainzngs.MusicBrainzError as exc:
+                self._metrics.error(u'musicbrainz', exc)
+                raise
+        for artist_mb in result['artist-list']:
+            return artist_mb['id']
+        return u''
+
+    def resolve_later(self, artist):
+        """Queue a foreign artist without mbid for MusicBrainz lookup."""
+        name = artist['myname']
+        self._unresolved.setdefault(name, []).append(artist)
+        self._resolver.submit(name)
+
+    def apply_resolved(self):
+        """Backfill the mbids the resolver found since the last call."""
+        for name, mbid in self._resolver.completed():
+            for artist in self._unresolved.pop(name, ()):
+                if mbid and not artist['mbid']:
+                    self.set_artist_mbid(artist, mbid)
+
+    def set_artist_mbid(self, artist, mbid):
+        """Give a foreign artist known by its last.fm url an mbid.
+
+        Its node is renamed from the url to the mbid in the graph, the
+        relation store and the journal. If another artist already has
+        this mbid the url stays the identity.
+        """
+        if (self._artistsForeign.get(ArtistNode(mbid, u'', u'')) or
+                self._artistsOwned.get(ArtistNode(mbid, u'', u''))):
+            self._log.debug(u'mbid {} of {} is taken', mbid,
+                            artist['myname'])
+            return
+        old = artist_identity(artist)
+        self._artistsForeign.set_mbid(artist, mbid)
+        self._relations.rename(old, mbid)
+        G = graph()
+        if old in G:
+            import networkx as nx
+            nx.relabel_nodes(G, {old: mbid}, copy=False)
+            G.nodes[mbid]['mbid'] = mbid
+            for neighbor, attrs in G[mbid].items():
+                for side in (u's', u't'):
+                    if attrs[side + u'lastfmurl'] == artist['lastfmurl'] and \
+                            not attrs[side + u'mbid']:
+                        attrs[side + u'mbid'] = mbid
+        if self._journal:
+            self._journal.add_rename(old, mbid)
+
+    @timed(u'save')
+    def save_graph(self, jsonfile):
+        """Write the whole graph in the configured format, replacing
+        jsonfile.
+        """
+        G = graph()
+        nodes = (dict(attrs, id=nid) for nid, attrs in G.nodes(data=True))
+        links = (dict(attrs, source=source, target=target)
+                 for source, target, attrs in G.edges(data=True))
+        if self._spill is not None:
+            self._spill.flush()
+            nodes = itertools.chain(nodes, self._spill.artists.records())
+            links = self._spill.relations.records()
+        write_graph_file(jsonfile, self.config['format'].as_choice(
+            GRAPH_FORMATS), dict(G.graph), nodes, links)
+
+    def add_graph_node(self, artist, journal=True):
+        """Add or update the node of artist in the graph."""
+        G = graph()
+        nid = artist_identity(artist)
+        if artist['group'] == 0 and G.nodes.get(nid, {}).get('group') == 1:
+            # an owned artist is never downgraded to a foreign one
+            return
+        attrs = node_attrs(artist)
+        if self._spill is not None and artist['group'] == 0:
+            self._spill.artists.append(artist)
+        else:
+            G.add_node(nid, **attrs)
+        if journal and self._journal:
+            self._journal.add_node(nid, attrs)
+        self._log.debug(u'#{}', nid)
+
+    def add_graph_edge(self, relation, journal=True):
+        """Add or update the edge of relation in the graph."""
+        G = graph()
+        source = artist_identity(relation, u'source_')
+        target = artist_identity(relation, u'target_')
+        attrs = relation_attrs(relation)
+        if self._spill is None:
+            # a spill store keeps the relation itself
+            G.add_edge(source, target, **attrs)
+        if journal and self._journal:
+            self._journal.add_edge(source, target, attrs)
+        self._log.debug(u'{}#{}', source, target)
+
+    @timed(u'import')
+    def import_graph(self, jsonfile):
+        """Import graph from previous created json file and its journal."""
+        G = graph()
+        nodes = []
+        links = []
+        if os.path.isfile(jsonfile):
+            graph_attrs, stored_nodes, stored_links = \
+                read_graph_file(jsonfile)
+            G.graph.update(graph_attrs)
+            nodes.extend(stored_nodes)
+            links.extend(stored_links)
+        self._journal.apply(nodes, links)
+
+        for count, attrs in enumerate(nodes):
+            if count % self.MEMORY_CHECK == 0:
+                self.check_memory()
+            self._log.debug(u'{}', attrs)
+            if not (attrs.get('mbid') or attrs.get('lastfmurl')):
+                continue
+            owned = attrs['group'] == 1
+            artistnode = ArtistNode(attrs['mbid'], attrs['id'],
+                                    attrs['lastfmurl'],
+                                    attrs['group'],
+                                    owned,
+                                    attrs['checked'])
+            artistnode['myname'] = attrs['myname'] or "unknown"
+            artistnode['fetched'] = attrs.get('fetched', 0)
+
+            stored = self._artistsOwned.get(artistnode)
+            if stored is None and owned:
+                # a promotion (see promote) replayed from the journal
+                foreign = self._artistsForeign.get(artistnode)
+                if foreign is not None:
+                    self._artistsForeign.remove(foreign)
+            elif stored is None:
+                stored = self._artistsForeign.get(artistnode)
+            elif not owned:
+                # an owned artist stays owned
+                self.add_graph_node(stored, journal=False)
+                continue
+            if stored is None:
+                registry = self._artistsOwned if owned \
+                    else self._artistsForeign
+                registry.append(artistnode)
+                stored = artistnode
+            else:
+                # journal entries are newer than the compacted file
+                stored['checked'] = artistnode['checked']
+                stored['myname'] = artistnode['myname']
+                stored['fetched'] = artistnode['fetched']
+            self.add_graph_node(stored, journal=False)
+
+        for count, attrs in enumerate(links):
+            if count % self.MEMORY_CHECK == 0:
+                self.check_memory()
+            relation = Relation(attrs['smbid'],
+                                attrs['tmbid'],
+                                attrs['slastfmurl'],
+                                attrs['tlastfmurl'],
+                                attrs['rate'],
+                                attrs.get('fetched', 0))
+            self.add_graph_edge(self._relations.upsert(relation),
+                                journal=False)
+
+
+GRAPH_FORMATS = ('json', 'binary')
+
+
+def read_graph_file(path):
+    """Read a graph file written in any of the GRAPH_FORMATS.
+
+    Returns the graph attributes and the node and link records in
+    node-link form. Binary files are recognized by their magic bytes.
+    """
+    with open(path, 'rb') as fp:
+        magic = fp.read(len(BinaryGraph.MAGIC))
+    if magic == BinaryGraph.MAGIC:
+        with BinaryGraph(path) as stored:
+            return stored.graph, list(stored.nodes()), list(stored.links())
+    with open(path) as data_file:
+        data = json.load(data_file)
+    return (data.get('graph', {}), data['nodes'],
+            data.get('links', data.get('edges', [])))
+
+
+def write_graph_file(path, fmt, graph_attrs, nodes, links):
+    """Atomically replace path with the graph in format fmt.
+
+    nodes and links may be iterators; the json format is written one
+    record at a time, so they are never all in memory at once.
+    """
+    tmpfile = path + u'.tmp'
+    if fmt == 'binary':
+        # the CSR arrays need all records
+        BinaryGraph.write(tmpfile, graph_attrs, list(nodes), list(links))
+    else:
+        def dump(records, fp):
+            for count, record in enumerate(records):
+                if count:
+                    fp.write(u', ')
+                fp.write(json.dumps(record))
+
+        with open(tmpfile, 'w') as fp:
+            fp.write(u'{{"directed": false, "multigraph": false, '
+                     u'"graph": {}, "nodes": ['.format(
+                         json.dumps(graph_attrs)))
+            dump(nodes, fp)
+            fp.write(u'], "links": [')
+            dump(links, fp)
+            fp.write(u']}')
+    os.replace(tmpfile, path)
+
+
+class BinaryGraph():
+    """Compact graph file that is read through a memory map.
+
+    Every string (artist ids, mbids, names, urls) is stored once in a
+    string table and referred to by its index; nodes are columns of
+    string indexes, edges a CSR adjacency (row offsets per source node,
+    target node indexes) with float32 rates. Attributes that do not fit
+    the columns are kept as json in a per-node/per-edge extra string, so
+    converting from and to node-link json is lossless except for rates:
+    they are read back rounded to the 7 significant digits of float32,
+    which still holds the 6 decimal match values last.fm returns.
+
+    Arrays are little endian and 4-byte aligned, and are used in place
+    through the memory map, which needs a little endian machine. Version
+    2 appends the ``fetched`` seconds of nodes and edges; version 1
+    files are still read.
+    """
+
+    MAGIC = b'BSIMGRPH'
+    VERSION = 2
+    HEADER = struct.Struct('<8sIIIIII')
+    NODE_COLUMNS = ('id', 'mbid', 'name', 'lastfmurl', 'myname')
+    EDGE_COLUMNS = ('smbid', 'tmbid', 'slastfmurl', 'tlastfmurl')
+
+    def __init__(self, path):
+        """Map the graph file at path."""
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        self._views = [view]
+        (magic, version, self.node_count, self.edge_count, string_count,
+         blob_size, graph_string) = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC or version not in (1, self.VERSION):
+            self.close()
+            raise ValueError(u'not a similarity graph file: {}'.format(path))
+        if sys.byteorder != 'little':
+            self.close()
+            raise ValueError(u'binary graph files need a little endian '
+                             u'machine, convert {} to json'.format(path))
+        offset = self.HEADER.size
+        self._strings = None
+
+        def take(typecode, count):
+            nonlocal offset
+            size = count * 4
+            chunk = view[offset:offset + size].cast(typecode)
+            self._views.append(chunk)
+            offset += size
+            return chunk
+
+        self._string_offsets = take('I', string_count + 1)
+        self._blob = view[offset:offset + blob_size]
+        self._views.append(self._blob)
+        offset += blob_size + -blob_size % 4
+        ncol = len(self.NODE_COLUMNS) + 1
+        self._node_strings = take('I', self.node_count * ncol)
+        self._groups = take('i', self.node_count)
+        self._checked = take('i', self.node_count)
+        self.indptr = take('I', self.node_count + 1)
+        self.indices = take('I', self.edge_count)
+        self.rates = take('f', self.edge_count)
+        self._edge_strings = take('I', self.edge_count *
+                                  (len(self.EDGE_COLUMNS) + 1))
+        self._fetched = self._edge_fetched = None
+        if version > 1:
+            self._fetched = take('I', self.node_count)
+            self._edge_fetched = take('I', self.edge_count)
+        self.graph = json.loads(self.string(graph_string) or u'{}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Release the memory map."""
+        for chunk in reversed(self._views):
+            chunk.release()
+        del self._views[:]
+        self._map.close()
+        self._file.close()
+
+    def string(self, index):
+        """Return entry index of the string table."""
+        start = self._string_offsets[index]
+        end = self._string_offsets[index + 1]
+        return bytes(self._blob[start:end]).decode('utf-8')
+
+    def strings(self):
+        """Return the whole string table decoded, for bulk reads."""
+        if self._strings is None:
+            blob = bytes(self._blob)
+            offsets = self._string_offsets
+            self._strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                             for i in range(len(offsets) - 1)]
+        return self._strings
+
+    def node_id(self, index):
+        """Return the id of node index."""
+        return self.string(self._node_strings[index])
+
+    def _columns(self, values, count, names):
+        """Split column-major string indexes into decoded columns."""
+        table = self.strings()
+        return [[table[i] for i in values[col * count:(col + 1) * count]]
+                for col in range(len(names) + 1)]
+
+    def nodes(self):
+        """Yield the node records in node-link form."""
+        columns = self._columns(self._node_strings, self.node_count,
+                                self.NODE_COLUMNS)
+        extras = columns.pop()
+        for index, values in enumerate(zip(*columns)):
+            attrs = dict(zip(self.NODE_COLUMNS, values))
+            attrs['group'] = self._groups[index]
+            attrs['checked'] = bool(self._checked[index])
+            if self._fetched is not None:
+                attrs['fetched'] = self._fetched[index]
+            if extras[index]:
+                attrs.update(json.loads(extras[index]))
+            yield attrs
+
+    def links(self):
+        """Yield the link records in node-link form."""
+        columns = self._columns(self._edge_strings, self.edge_count,
+                                self.EDGE_COLUMNS)
+        extras = columns.pop()
+        ids = self._columns(self._node_strings, self.node_count, ())[0]
+        indptr = self.indptr
+        indices = self.indices
+        rates = self.rates
+        for source in range(self.node_count):
+            for edge in range(indptr[source], indptr[source + 1]):
+                attrs = dict((key, column[edge]) for key, column
+                             in zip(self.EDGE_COLUMNS, columns))
+                attrs['source'] = ids[source]
+                attrs['target'] = ids[indices[edge]]
+                attrs['rate'] = float('%.7g' % rates[edge])
+                if self._edge_fetched is not None:
+                    attrs['fetched'] = self._edge_fetched[edge]
+                if extras[edge]:
+                    attrs.update(json.loads(extras[edge]))
+                yield attrs
+
+    @classmethod
+    def write(cls, path, graph_attrs, nodes, links):
+        """Write graph attributes, node and link records to path."""
+        strings = {}
+        table = []
+
+        def intern(value):
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(table)
+                table.append(value)
+            return index
+
+        intern(u'')
+        graph_string = intern(json.dumps(graph_attrs, sort_keys=True)
+                              if graph_attrs else u'')
+
+        def split(record, columns, typed):
+            """Return (string indexes, typed values, extra json)."""
+            extra = {}
+            indexes = []
+            for key in columns:
+                value = record.get(key, u'')
+                if isinstance(value, str):
+                    indexes.append(intern(value))
+                else:
+                    indexes.append(intern(u''))
+                    extra[key] = value
+            values = []
+            for key, check, default in typed:
+                value = record.get(key, default)
+                if check(value):
+                    values.append(value)
+                else:
+                    values.append(default)
+                    extra[key] = value
+            known = set(columns) | set(key for key, _, _ in typed)
+            extra.update((key, value) for key, value in record.items()
+                         if key not in known)
+            indexes.append(intern(json.dumps(extra, sort_keys=True)
+                                  if extra else u''))
+            return indexes, values
+
+        n = len(nodes)
+        node_strings = [array('I', [0]) * n
+                        for _ in range(len(cls.NODE_COLUMNS) + 1)]
+        groups = array('i', [0]) * n
+        checked = array('i', [0]) * n
+        fetched = array('I', [0]) * n
+        position = {}
+        node_typed = (('group', lambda v: type(v) is int, 0),
+                      ('checked', lambda v: type(v) is bool, False),
+                      ('fetched', cls._seconds, 0))
+        for index, record in enumerate(nodes):
+            position[record['id']] = index
+            indexes, (group, check, seconds) = split(
+                record, cls.NODE_COLUMNS, node_typed)
+            for col, value in enumerate(indexes):
+                node_strings[col][index] = value
+            groups[index] = group
+            checked[index] = int(check)
+            fetched[index] = seconds
+
+        # CSR: edges grouped by their source node, in link order
+        rows = [[] for _ in range(n)]
+        for link in links:
+            rows[position[link['source']]].append(link)
+        m = len(links)
+        indptr = array('I', [0]) * (n + 1)
+        indices = array('I', [0]) * m
+        rates = array('f', [0.0]) * m
+        edge_fetched = array('I', [0]) * m
+        edge_strings = [array('I', [0]) * m
+                        for _ in range(len(cls.EDGE_COLUMNS) + 1)]
+        edge_typed = (('rate', lambda v: isinstance(v, (int, float)) and
+                       not isinstance(v, bool), 0.0),
+                      ('fetched', cls._seconds, 0))
+        edge = 0
+        for source, row in enumerate(rows):
+            for link in row:
+                indices[edge] = position[link['target']]
+                record = dict((key, value) for key, value in link.items()
+                              if key not in ('source', 'target'))
+                indexes, (rate, seconds) = split(record, cls.EDGE_COLUMNS,
+                                                 edge_typed)
+                rates[edge] = rate
+                edge_fetched[edge] = seconds
+                for col, value in enumerate(indexes):
+                    edge_strings[col][edge] = value
+                edge += 1
+            indptr[source + 1] = edge
+
+        encoded = [value.encode('utf-8') for value in table]
+        string_offsets = array('I', [0]) * (len(encoded) + 1)
+        for index, value in enumerate(encoded):
+            string_offsets[index + 1] = string_offsets[index] + len(value)
+        blob = b''.join(encoded)
+
+        arrays = (node_strings + [groups, checked, indptr, indices, rates] +
+                  edge_strings + [fetched, edge_fetched])
+        with open(path, 'wb') as fp:
+            fp.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, n, m,
+                                     len(encoded), len(blob), graph_string))
+            cls._dump(fp, string_offsets)
+            fp.write(blob)
+            fp.write(b'\0' * (-len(blob) % 4))
+            for values in arrays:
+                cls._dump(fp, values)
+
+    @staticmethod
+    def _seconds(value):
+        """Check whether value fits a fetched column."""
+        return type(value) is int and 0 <= value < 1 << 32
+
+    @staticmethod
+    def _dump(fp, values):
+        """Write an array in little endian byte order."""
+        if sys.byteorder != 'little':
+            values = array(values.typecode, values)
+            values.byteswap()
+        values.tofile(fp)
+
+
+class SimilarityIndex():
+    """Stored graph indexed for neighbor queries.
+
+    Nodes are indexed by mbid up front. The neighbors of a node are
+    split into owned and not owned lists sorted by descending rate the
+    first time the node is queried and kept, so repeated lookups only
+    read the first k entries of these lists.
+    """
+
+    def __init__(self, nodes, adjacency):
+        """Index nodes (id -> attributes) and adjacency (id -> neighbor
+        id -> edge attributes), e.g. ``G.nodes`` and ``G.adj``.
+        """
+        self._nodes = nodes
+        self._adjacency = adjacency
+        self._by_mbid = {}
+        for nid in nodes:
+            mbid = nodes[nid].get('mbid')
+            if mbid:
+                self._by_mbid[mbid] = nid
+        self._sorted = {}
+        self._names = None
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Index a networkx graph without copying it."""
+        return cls(graph.nodes, graph.adj)
+
+    @classmethod
+    def from_records(cls, nodes, links):
+        """Index node-link records.
+
+        Later records of a node or an artist pair replace earlier ones,
+        so a journal can be appended to the records of the graph file.
+        """
+        index = {}
+        for attrs in nodes:
+            index[attrs['id']] = attrs
+        adjacency = dict((nid, {}) for nid in index)
+        for link in links:
+            source, target = link['source'], link['target']
+            adjacency.setdefault(source, {})[target] = link
+            adjacency.setdefault(target, {})[source] = link
+        return cls(index, adjacency)
+
+    def __len__(self):
+        """Return number of nodes."""
+        return len(self._nodes)
+
+    def find(self, artist):
+        """Return the node id of an artist given by mbid or node id."""
+        nid = self._by_mbid.get(artist, artist)
+        return nid if nid in self._nodes else None
+
+    def node(self, nid):
+        """Return the attributes of node nid."""
+        return self._nodes[nid]
+
+    def neighbors(self, nid):
+        """Return the (owned, not owned) neighbor lists of nid."""
+        lists = self._sorted.get(nid)
+        if lists is None:
+            owned = []
+            foreign = []
+            for neighbor, attrs in self._adjacency.get(nid, {}).items():
+                if neighbor not in self._nodes:
+                    # a relation to an artist without node record
+                    continue
+                group = self._nodes[neighbor].get('group')
+                (owned if group == 1 else foreign).append(
+                    (neighbor, attrs['rate']))
+            for entries in (owned, foreign):
+                entries.sort(key=lambda entry: (-entry[1], entry[0]))
+            lists = self._sorted[nid] = (owned, foreign)
+        return lists
+
+    def ids(self):
+        """Return the node ids."""
+        return iter(self._nodes)
+
+    def edges(self, nid):
+        """Yield (neighbor id, rate) of the relations of nid."""
+        for neighbor, attrs in self._adjacency.get(nid, {}).items():
+            if neighbor in self._nodes:
+                yield neighbor, attrs['rate']
+
+    def top_similar(self, artist, k=None, owned=None):
+        """Return up to k (node id, rate) pairs of the most similar
+        artists, best first.
+
+        artist is an mbid or node id. ``owned`` restricts the result to
+        owned (True) or not owned (False) artists. k=None returns all.
+        """
+        nid = self.find(artist)
+        if nid is None:
+            return []
+        owned_list, foreign_list = self.neighbors(nid)
+        if owned is None:
+            entries = heapq.merge(owned_list, foreign_list,
+                                  key=lambda entry: -entry[1])
+        else:
+            entries = owned_list if owned else foreign_list
+        return list(itertools.islice(entries, k))
+
+    def ego(self, artist, radius=2, min_rate=0, limit=100):
+        """Return (node ids, links) of the neighborhood of artist.
+
+        Walks up to radius relations from the artist, the strongest
+        relations of every node first, skipping rates below min_rate,
+        until limit nodes are found. links are (source, target, rate)
+        of all relations among the found nodes.
+        """
+        nid = self.find(artist)
+        if nid is None:
+            return [], []
+        found = [nid]
+        seen = set(found)
+        ring = [nid]
+        for _ in range(radius):
+            following = []
+            for current in ring:
+                owned_list, foreign_list = self.neighbors(current)
+                for neighbor, rate in heapq.merge(
+                        owned_list, foreign_list,
+                        key=lambda entry: -entry[1]):
+                    if rate < min_rate or len(found) >= limit:
+                        break
+                    if neighbor not in seen:
+                        seen.add(neighbor)
+                        found.append(neighbor)
+                        following.append(neighbor)
+            if not following:
+                break
+            ring = following
+        links = []
+        for source in found:
+            for target, attrs in self._adjacency.get(source, {}).items():
+                if target in seen and source < target and \
+                        attrs['rate'] >= min_rate:
+                    links.append((source, target, attrs['rate']))
+        return found, links
+
+    def search(self, name, limit=20):
+        """Return up to limit node ids whose name starts with name, then
+        ones that contain it, compared like normalize_name.
+        """
+        if self._names is None:
+            self._names = sorted(
+                (normalize_name(attrs.get('myname') or u''), nid)
+                for nid, attrs in self._nodes.items())
+        name = normalize_name(name)
+        if not name:
+            return []
+        result = []
+        start = bisect.bisect_left(self._names, (name,))
+        for label, nid in self._names[start:start + limit]:
+            if not label.startswith(name):
+                break
+            result.append(nid)
+        matched = set(result)
+        for label, nid in self._names:
+            if len(result) >= limit:
+                break
+            if name in label and nid not in matched:
+                result.append(nid)
+        return result
+
+
+class PathFinder():
+    """Best connections between two artists of a SimilarityIndex.
+
+    ``strongest`` paths minimize the sum of -log(rate / 1000) over
+    their relations, i.e. maximize the product of the similarity
+    matches; ``shortest`` paths minimize the number of hops. The best
+    path is found by a bidirectional Dijkstra which skips artists whose
+    landmark lower bound (see LandmarkTable) shows they cannot improve
+    the best path found so far; Yen's algorithm adds the next k-1 loop
+    free paths. Answers are kept in an LRU of CACHE_SIZE queries.
+    """
+
+    MODES = ('strongest', 'shortest')
+    CACHE_SIZE = 1024
+
+    def __init__(self, index, mode='strongest', table=None):
+        """Constructor of class."""
+        if mode not in self.MODES:
+            raise ValueError(u'unknown path mode: {}'.format(mode))
+        self.index = index
+        self.mode = mode
+        self._table = table
+        self._edges = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        """Return the landmark table, building it on first use."""
+        if self._table is None:
+            self._table = LandmarkTable.build(self)
+        return self._table
+
+    def cost(self, rate):
+        """Return the cost of a relation with rate."""
+        if self.mode == 'shortest':
+            return 1.0
+        return -math.log(min(1.0, max(rate, 0.001) / 1000.0))
+
+    def edges(self, nid):
+        """Return the (neighbor, cost) pairs of nid."""
+        edges = self._edges.get(nid)
+        if edges is None:
+            edges = self._edges[nid] = [
+                (neighbor, self.cost(rate))
+                for neighbor, rate in self.index.edges(nid)]
+        return edges
+
+    def path_cost(self, path):
+        """Return the cost of a path of node ids."""
+        return sum(dict(self.edges(source))[target]
+                   for source, target in zip(path, path[1:]))
+
+    def search(self, source, target, blocked_nodes=(), blocked_edges=(),
+               limit=float('inf'), toward=None):
+        """Return (cost, path) of the cheapest path from source to target
+        cheaper than limit or None.
+
+        Paths do not pass blocked_nodes or use one of the blocked_edges,
+        given as (from, to) pairs in the direction of the path. toward
+        may pass on the estimator of target of an earlier search.
+        """
+        if source == target:
+            return 0.0, [source]
+        infinity = float('inf')
+        dist = ({source: 0.0}, {target: 0.0})
+        parent = ({source: None}, {target: None})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        settled = (set(), set())
+        bounds = (toward or self.table.estimator(target),
+                  self.table.estimator(source))
+        best, meet = limit, None
+        while heaps[0] and heaps[1]:
+            # no path through unsettled artists can be cheaper
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+            cost, nid = heapq.heappop(heaps[side])
+            if nid in settled[side]:
+                continue
+            settled[side].add(nid)
+            other = dist[1 - side]
+            bound = bounds[side]
+            for neighbor, step in self.edges(nid):
+                if neighbor in blocked_nodes or blocked_edges and (
+                        (nid, neighbor) if side == 0 else
+                        (neighbor, nid)) in blocked_edges:
+                    continue
+                total = cost + step
+                if total >= dist[side].get(neighbor, infinity) or \
+                        total + bound(neighbor) >= best:
+                    continue
+                dist[side][neighbor] = total
+                parent[side][neighbor] = nid
+                heapq.heappush(heaps[side], (total, neighbor))
+                if neighbor in other and total + other[neighbor] < best:
+                    best, meet = total + other[neighbor], neighbor
+        if meet is None:
+            return None
+        path = []
+        nid = meet
+        while nid is not None:
+            path.append(nid)
+            nid = parent[0][nid]
+        path.reverse()
+        nid = parent[1][meet]
+        while nid is not None:
+            path.append(nid)
+            nid = parent[1][nid]
+        return best, path
+
+    def paths(self, source, target, k=3):
+        """Return up to k (cost, path) of the best paths from source to
+        target, best first.
+        """
+        with self._lock:
+            key = (source, target, k)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            reverse = (target, source, k)
+            if reverse in self._cache:
+                return [(cost, path[::-1])
+                        for cost, path in self._cache[reverse]]
+        found = self.yen(source, target, k)
+        with self._lock:
+            self._cache[key] = found
+            if len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return found
+
+    def yen(self, source, target, k):
+        """Find the k best loop free paths with Yen's algorithm."""
+        if not self.table.connected(source, target):
+            return []
+        toward = self.table.estimator(target)
+        first = self.search(source, target, toward=toward)
+        if first is None:
+            return []
+        found = [first]
+        seen = set([tuple(first[1])])
+        candidates = []
+        while len(found) < k:
+            path = found[-1][1]
+            for i in range(len(path) - 1):
+                root = path[:i + 1]
+                blocked_edges = set(
+                    (other[i], other[i + 1]) for _, other in found
+                    if len(other) > i + 1 and other[:i + 1] == root)
+                # only spurs beating the candidates still needed count
+                need = k - len(found)
+                limit = float('inf')
+                if len(candidates) >= need:
+                    limit = heapq.nsmallest(need, candidates)[-1][0] - \
+                        self.path_cost(root) + 1e-9
+                spur = self.search(path[i], target, set(root[:-1]),
+                                   blocked_edges, limit, toward)
+                if spur is None:
+                    continue
+                candidate = root[:-1] + spur[1]
+                if tuple(candidate) not in seen:
+                    seen.add(tuple(candidate))
+                    heapq.heappush(candidates,
+                                   (self.path_cost(candidate), candidate))
+            if not candidates:
+                break
+            found.append(heapq.heappop(candidates))
+        return found
+
+
+class LandmarkTable():
+    """Distances of every artist to a few landmark artists.
+
+    By the triangle inequality the cost of any path between two
+    artists is at least the difference of their distances to a
+    landmark, which lets PathFinder skip hopeless artists. The table
+    also keeps the connected component of every artist, so a pair in
+    different components is unreachable without a search. Landmarks
+    are picked farthest first, starting at the best connected artist;
+    the table is cached next to the graph file.
+    """
+
+    COUNT = 8
+
+    def __init__(self, ids, components, distances):
+        """Constructor of class."""
+        self.ids = ids
+        self.components = components
+        self.distances = distances
+        self._position = dict((nid, pos) for pos, nid in enumerate(ids))
+
+    @classmethod
+    def build(cls, finder, count=COUNT):
+        """Compute the table for the graph and costs of finder."""
+        ids = list(finder.index.ids())
+        position = dict((nid, pos) for pos, nid in enumerate(ids))
+        components = array('i', [-1]) * len(ids)
+        label = 0
+        for start in range(len(ids)):
+            if components[start] >= 0:
+                continue
+            components[start] = label
+            stack = [ids[start]]
+            while stack:
+                for neighbor, _ in finder.edges(stack.pop()):
+                    pos = position[neighbor]
+                    if components[pos] < 0:
+                        components[pos] = label
+                        stack.append(neighbor)
+            label += 1
+        distances = []
+        if ids:
+            nearest = None
+            landmark = max(ids, key=lambda nid: len(finder.edges(nid)))
+            for _ in range(min(count, len(ids))):
+                row = cls.dijkstra(finder, landmark, position)
+                distances.append(row)
+                nearest = row if nearest is None else array(
+                    'd', map(min, nearest, row))
+                # the artist of the component farthest from all landmarks
+                far = max(range(len(ids)),
+                          key=lambda pos: nearest[pos]
+                          if nearest[pos] < float('inf') else -1)
+                if nearest[far] <= 0 or nearest[far] == float('inf'):
+                    break
+                landmark = ids[far]
+        return cls(ids, components, distances)
+
+    @staticmethod
+    def dijkstra(finder, source, position):
+        """Return the costs from source to all artists by position."""
+        row = array('d', [float('inf')]) * len(position)
+        row[position[source]] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            cost, nid = heapq.heappop(heap)
+            if cost > row[position[nid]]:
+                continue
+            for neighbor, step in finder.edges(nid):
+                pos = position[neighbor]
+                if cost + step < row[pos]:
+                    row[pos] = cost + step
+                    heapq.heappush(heap, (cost + step, neighbor))
+        return row
+
+    def connected(self, source, target):
+        """Check whether there is any path between two artists."""
+        return self.components[self._position[source]] == \
+            self.components[self._position[target]]
+
+    def estimator(self, target):
+        """Return a function giving a lower bound of the cost from an
+        artist to target, memoized per artist.
+        """
+        infinity = float('inf')
+        position = self._position
+        components = self.components
+        goal = position[target]
+        label = components[goal]
+        rows = [(row, row[goal]) for row in self.distances
+                if row[goal] < infinity]
+        memo = {}
+
+        def bound(nid):
+            value = memo.get(nid)
+            if value is None:
+                pos = position[nid]
+                if components[pos] != label:
+                    value = infinity
+                else:
+                    value = max([abs(row[pos] - cost) for row, cost in rows],
+                                default=0.0)
+                memo[nid] = value
+            return value
+        return bound
+
+    @classmethod
+    def load(cls, path, sources):
+        """Load a cached table unless one of the sources is newer."""
+        if not os.path.isfile(path):
+            return None
+        stamp = os.path.getmtime(path)
+        if any(os.path.isfile(source) and os.path.getmtime(source) > stamp
+               for source in sources):
+            return None
+        with open(path) as fp:
+            data = json.load(fp)
+        return cls(data['ids'], array('i', data['components']),
+                   [array('d', (float('inf') if cost < 0 else cost
+                                for cost in row))
+                    for row in data['distances']])
+
+    def save(self, path):
+        """Cache the table in path."""
+        tmpfile = path + u'.tmp'
+        with open(tmpfile, 'w') as fp:
+            json.dump({'ids': self.ids,
+                       'components': self.components.tolist(),
+                       'distances': [[-1 if cost == float('inf') else cost
+                                      for cost in row]
+                                     for row in self.distances]}, fp)
+        os.replace(tmpfile, path)
+
+
+class SimilarityServer():
+    """HTTP server answering neighborhood and search queries.
+
+    Keeps one SimilarityIndex of the stored graph in memory and answers
+    ``/artist/<id>/ego?radius=&min_rate=&limit=``, ``/search?q=&limit=``
+    and ``/path?from=&to=&k=&by=`` with small json documents; other paths are
+    files of the viewer in ``root``. Answers carry an ETag made of the
+    version of the graph and the request, so a browser asking again gets
+    a 304 without the query being run, and are gzipped when the client
+    accepts it.
+    """
+
+    MAX_LIMIT = 5000
+    MAX_RADIUS = 10
+    GZIP_MIN = 1024
+
+    def __init__(self, index, version, root=None):
+        """Constructor of class."""
+        self.index = index
+        self.version = version
+        self.root = root
+        self._finders = {}
+        self._lock = threading.Lock()
+
+    def finder(self, mode):
+        """Return the PathFinder of mode, built on first use."""
+        with self._lock:
+            if mode not in self._finders:
+                finder = PathFinder(self.index, mode)
+                finder.table
+                self._finders[mode] = finder
+            return self._finders[mode]
+
+    def artist(self, nid):
+        """Return the json record of node nid."""
+        attrs = self.index.node(nid)
+        return {'id': nid, 'name': attrs.get('myname') or u'',
+                'group': attrs.get('group', 0),
+                'lastfmurl': attrs.get('lastfmurl') or u''}
+
+    @staticmethod
+    def number(query, key, default, cast=int):
+        """Return query parameter key as a number or default."""
+        try:
+            return cast(query[key][0])
+        except (KeyError, IndexError, ValueError):
+            return default
+
+    def answer(self, path, query):
+        """Return (status, document) for a query path."""
+        parts = [unquote(part) for part in path.strip(u'/').split(u'/')]
+        limit = max(1, min(self.MAX_LIMIT, self.number(query, 'limit', 100)))
+        if len(parts) == 3 and parts[0] == u'artist' and parts[2] == u'ego':
+            radius = max(0, min(self.MAX_RADIUS,
+                                self.number(query, 'radius', 2)))
+            nodes, links = self.index.ego(
+                parts[1], radius,
+                self.number(query, 'min_rate', 0, float), limit)
+            if not nodes:
+                return 404, {'error': u'unknown artist'}
+            return 200, {'center': nodes[0],
+                         'nodes': [self.artist(nid) for nid in nodes],
+                         'links': [{'source': source, 'target': target,
+                                    'rate': rate}
+                                   for source, target, rate in links]}
+        if parts == [u'search']:
+            name = query.get('q', [u''])[0]
+            return 200, {'artists': [self.artist(nid) for nid in
+                                     self.index.search(name, limit)]}
+        if parts == [u'path']:
+            ends = [self.index.find(query.get(key, [u''])[0])
+                    for key in ('from', 'to')]
+            mode = query.get('by', [u'strongest'])[0]
+            if None in ends:
+                return 404, {'error': u'unknown artist'}
+            if mode not in PathFinder.MODES:
+                return 400, {'error': u'unknown mode'}
+            k = max(1, min(10, self.number(query, 'k', 3)))
+            found = self.finder(mode).paths(ends[0], ends[1], k)
+            return 200, {'paths': [{'cost': cost, 'artists': [
+                self.artist(nid) for nid in path]} for cost, path in found]}
+        return None, None
+
+    def serve(self, host, port, log):
+        """Serve until interrupted."""
+        from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlsplit
+        import gzip
+        import hashlib
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+
+            def __init__(self, *args, **kwargs):
+                super(Handler, self).__init__(*args, directory=server.root,
+                                              **kwargs)
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                etag = u'"{}"'.format(hashlib.sha1(u'{} {}'.format(
+                    server.version, self.path).encode('utf-8')).hexdigest())
+                if parts.path.startswith((u'/artist/', u'/search',
+                                          u'/path')) and \
+                        self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                status, document = server.answer(parts.path,
+                                                 parse_qs(parts.query))
+                if status is None:
+                    if server.root is None:
+                        self.send_error(404)
+                        return
+                    return super(Handler, self).do_GET()
+                body = json.dumps(document, separators=(',', ':')).encode(
+                    'utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('ETag', etag)
+                self.send_header('Vary', 'Accept-Encoding')
+                if len(body) >= server.GZIP_MIN and 'gzip' in \
+                        self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug(u'{}', fmt % args)
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        log.info(u'serving {} artists on http://{}:{}/', len(self.index),
+                 host, httpd.server_address[1])
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+
+
+class Recommender():
+    """Score not owned artists against a set of seed artists.
+
+    The graph is turned once into a symmetric sparse matrix of rates,
+    which is cached as ``<graph>.matrix.npz`` until the graph file or
+    its journal change. A whole seed set is scored at once: ``sum``
+    adds the rates to all seeds, ``max`` keeps the best rate to any
+    seed, ``pagerank`` runs a personalized pagerank restarting at the
+    seeds by power iteration. Needs numpy and scipy.
+    """
+
+    MODES = ('sum', 'max', 'pagerank')
+    DAMPING = 0.85
+    TOLERANCE = 1e-8
+    MAX_ITERATIONS = 100
+
+    def __init__(self, ids, mbids, labels, groups, matrix):
+        """Constructor of class."""
+        self.ids = ids
+        self.mbids = mbids
+        self.labels = labels
+        self.groups = groups
+        self.matrix = matrix.tocsr()
+        self._by_mbid = dict((mbid, pos) for pos, mbid in enumerate(mbids)
+                             if mbid)
+
+    @staticmethod
+    def modules():
+        """Import numpy and scipy.sparse."""
+        try:
+            import numpy
+            import scipy.sparse
+        except ImportError:
+            raise ui.UserError(u'recommendations and --export-viz need numpy '
+                               u'and scipy')
+        return numpy, scipy.sparse
+
+    @classmethod
+    def from_records(cls, nodes, links):
+        """Build the matrix from node-link records."""
+        np, sparse = cls.modules()
+        attrs = {}
+        for record in nodes:
+            attrs[record['id']] = record
+        position = dict((nid, pos) for pos, nid in enumerate(attrs))
+        rates = {}
+        for link in links:
+            source = position.get(link['source'])
+            target = position.get(link['target'])
+            if source is None or target is None or source == target:
+                continue
+            rates[(min(source, target), max(source, target))] = link['rate']
+        pairs = np.array(list(rates), dtype=np.int64).reshape(-1, 2)
+        values = np.fromiter(rates.values(), dtype=np.float64,
+                             count=len(rates))
+        n = len(attrs)
+        matrix = sparse.coo_matrix(
+            (np.concatenate([values, values]),
+             (np.concatenate([pairs[:, 0], pairs[:, 1]]),
+              np.concatenate([pairs[:, 1], pairs[:, 0]]))), shape=(n, n))
+        records = list(attrs.values())
+        return cls(list(attrs),
+                   [record.get('mbid') or u'' for record in records],
+                   [record.get('myname') or record.get('lastfmurl') or u''
+                    for record in records],
+                   np.array([record.get('group', 0) for record in records],
+                            dtype=np.int8),
+                   matrix)
+
+    @classmethod
+    def load(cls, path, sources):
+        """Load a cached matrix unless one of the sources is newer."""
+        if not os.path.isfile(path):
+            return None
+        stamp = os.path.getmtime(path)
+        if any(os.path.isfile(source) and os.path.getmtime(source) > stamp
+               for source in sources):
+            return None
+        np, sparse = cls.modules()
+        with np.load(path) as data:
+            matrix = sparse.csr_matrix(
+                (data['data'], data['indices'], data['indptr']),
+                shape=tuple(data['shape']))
+            return cls(data['ids'].tolist(), data['mbids'].tolist(),
+                       data['labels'].tolist(), data['groups'], matrix)
+
+    def save(self, path):
+        """Cache the matrix in path."""
+        np, _ = self.modules()
+        tmpfile = path + u'.tmp.npz'
+        np.savez(tmpfile, data=self.matrix.data, indices=self.matrix.indices,
+                 indptr=self.matrix.indptr,
+                 shape=np.array(self.matrix.shape),
+                 ids=np.array(self.ids, dtype=np.str_),
+                 mbids=np.array(self.mbids, dtype=np.str_),
+                 labels=np.array(self.labels, dtype=np.str_),
+                 groups=self.groups)
+        os.replace(tmpfile, path)
+
+    def positions(self, mbids):
+        """Return the matrix positions of the artists with mbids."""
+        return sorted(self._by_mbid[mbid] for mbid in mbids
+                      if mbid in self._by_mbid)
+
+    def label(self, pos):
+        """Return the display name of the artist at pos."""
+        return self.labels[pos]
+
+    def scores(self, seeds, mode='sum'):
+        """Return the score of every artist against the seed positions."""
+        np, _ = self.modules()
+        n = self.matrix.shape[0]
+        if mode == 'sum':
+            seed = np.zeros(n)
+            seed[seeds] = 1.0
+            return self.matrix.dot(seed)
+        if mode == 'max':
+            if not seeds:
+                return np.zeros(n)
+            # the matrix is symmetric: rows of the seeds are their columns
+            return self.matrix[seeds].max(axis=0).toarray().ravel()
+        if mode == 'pagerank':
+            return self.pagerank(seeds)
+        raise ValueError(u'unknown mode: {}'.format(mode))
+
+    def pagerank(self, seeds):
+        """Personalized pagerank restarting at the seeds."""
+        np, sparse = self.modules()
+        n = self.matrix.shape[0]
+        restart = np.zeros(n)
+        if not seeds:
+            return restart
+        restart[seeds] = 1.0 / len(seeds)
+        degree = np.asarray(self.matrix.sum(axis=1)).ravel()
+        inverse = np.divide(1.0, degree, out=np.zeros(n), where=degree > 0)
+        # column stochastic transition matrix, dangling mass restarts
+        transition = self.matrix.dot(sparse.diags(inverse))
+        dangling = degree == 0
+        rank = restart.copy()
+        for _ in range(self.MAX_ITERATIONS):
+            previous = rank
+            rank = (self.DAMPING * (transition.dot(rank) +
+                                    rank[dangling].sum() * restart) +
+                    (1 - self.DAMPING) * restart)
+            if np.abs(rank - previous).sum() < self.TOLERANCE:
+                break
+        return rank
+
+    def recommend(self, seeds, mode='sum', top=20):
+        """Return up to top (position, score) pairs of not owned artists,
+        best first.
+        """
+        np, _ = self.modules()
+        scores = self.scores(seeds, mode)
+        candidates = np.flatnonzero((self.groups == 0) & (scores > 0))
+        candidates = candidates[~np.isin(candidates, seeds)]
+        if len(candidates) > top:
+            best = np.argpartition(-scores[candidates], top - 1)[:top]
+            candidates = candidates[best]
+        order = np.lexsort((candidates, -scores[candidates]))
+        return [(int(pos), float(scores[pos]))
+                for pos in candidates[order]]
+
+
+class GraphLayout():
+    """Node positions for the viewer and level-of-detail files.
+
+    The layout is force directed and vectorized: edges pull their ends
+    together through one sparse product with the rate matrix, and nodes
+    push each other apart along the gradient of their density, counted
+    on a grid and smoothed with a gaussian filter. An iteration costs
+    O(edges + nodes + cells), so a hundred thousand artists are laid
+    out in seconds. Positions of a previous export are used as start,
+    which needs fewer and smaller steps and keeps the picture stable.
+    Needs numpy and scipy.
+
+    Levels are written best artists first, owned artists before the
+    others and then by the sum of their rates; each level has four
+    times the artists of the previous one and keeps the strongest
+    ``2 << level`` relations of every artist.
+    """
+
+    SIZE = 1000
+    ITERATIONS = 100
+    SEEDED_ITERATIONS = 30
+    LEVEL_NODES = 500
+
+    def __init__(self, ids, labels, groups, matrix):
+        """Constructor of class."""
+        self.ids = ids
+        self.labels = labels
+        self.groups = groups
+        self.matrix = matrix.tocsr()
+
+    @classmethod
+    def from_records(cls, nodes, links):
+        """Build the rate matrix from node-link records."""
+        matrix = Recommender.from_records(nodes, links)
+        return cls(matrix.ids, matrix.labels, matrix.groups, matrix.matrix)
+
+    def layout(self, previous=None):
+        """Return node positions scaled to SIZE x SIZE.
+
+        previous maps node ids to positions of an earlier export;
+        nodes without one start next to their placed neighbors.
+        """
+        np, _ = Recommender.modules()
+        from scipy.ndimage import gaussian_filter
+        n = len(self.ids)
+        side = max(1.0, np.sqrt(n))
+        weights = self.matrix.astype(np.float64)
+        if weights.nnz:
+            weights.data /= weights.data.max()
+        degree = np.asarray(weights.sum(axis=1)).ravel()
+        rnd = np.random.RandomState(0)
+        positions = rnd.uniform(0, side, (n, 2))
+        iterations = self.ITERATIONS
+        heat = 0.1
+        if previous:
+            placed = np.zeros(n, dtype=bool)
+            for pos, nid in enumerate(self.ids):
+                if nid in previous:
+                    positions[pos] = previous[nid]
+                    placed[pos] = True
+            positions[placed] *= side / self.SIZE
+            # new nodes start at the mean of their placed neighbors
+            near = weights[:, placed]
+            count = np.asarray(near.sum(axis=1)).ravel()
+            new = ~placed & (count > 0)
+            positions[new] = (near[new] @ positions[placed]) / \
+                count[new, None] + rnd.normal(0, 0.5, (new.sum(), 2))
+            if placed.any():
+                iterations = self.SEEDED_ITERATIONS
+                heat = 0.02
+        cells = int(min(512, max(8, 2 * side)))
+        for step in range(iterations):
+            limit = side * heat * (1 - step / iterations) + 0.01
+            attract = weights @ positions - degree[:, None] * positions
+            low = positions.min(axis=0)
+            cell = ((positions.max(axis=0) - low).max() + 1e-9) / cells
+            index = np.minimum(((positions - low) / cell).astype(int),
+                               cells - 1)
+            density = np.zeros((cells, cells))
+            np.add.at(density, (index[:, 0], index[:, 1]), 1.0)
+            potential = gaussian_filter(density, max(1.0, cells / 32),
+                                        mode='constant')
+            grad_x, grad_y = np.gradient(potential)
+            repulse = -np.stack([grad_x[index[:, 0], index[:, 1]],
+                                 grad_y[index[:, 0], index[:, 1]]], axis=1)
+            move = attract + repulse * (side / 2 / cell)
+            length = np.sqrt((move ** 2).sum(axis=1)) + 1e-9
+            positions += move * (np.minimum(length, limit) / length)[:, None]
+        low = positions.min(axis=0)
+        span = (positions.max(axis=0) - low).max() or 1.0
+        return (positions - low) * (self.SIZE / span)
+
+    def levels(self):
+        """Yield (node positions, (source, target, rate) arrays) per
+        level, sources and targets as positions in the level.
+        """
+        np, sparse = Recommender.modules()
+        strength = np.asarray(self.matrix.sum(axis=1)).ravel()
+        order = np.lexsort((-strength, -self.groups.astype(np.int64)))
+        n = len(order)
+        size = self.LEVEL_NODES
+        level = 0
+        while True:
+            size = min(size, n)
+            chosen = order[:size]
+            sub = self.matrix[chosen][:, chosen].tocoo()
+            # strongest relations of every artist
+            rank = np.lexsort((-sub.data, sub.row))
+            rows, cols, rates = sub.row[rank], sub.col[rank], sub.data[rank]
+            first = np.searchsorted(rows, rows)
+            keep = np.arange(len(rows)) - first < 2 << level
+            rows, cols, rates = rows[keep], cols[keep], rates[keep]
+            pairs = np.minimum(rows, cols) * np.int64(size) + \
+                np.maximum(rows, cols)
+            _, unique = np.unique(pairs, return_index=True)
+            yield chosen, (rows[unique], cols[unique], rates[unique])
+            if size == n:
+                return
+            size *= 4
+            level += 1
+
+    def write(self, directory, positions):
+        """Write index.json and one lod<level>.json per level."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        levels = []
+        for level, (chosen, (rows, cols, rates)) in enumerate(self.levels()):
+            filename = u'lod{}.json'.format(level)
+            nodes = [{'id': self.ids[pos], 'name': self.labels[pos],
+                      'group': int(self.groups[pos]),
+                      'x': round(float(positions[pos, 0]), 1),
+                      'y': round(float(positions[pos, 1]), 1)}
+                     for pos in chosen]
+            links = [{'source': int(source), 'target': int(target),
+                      'rate': int(round(rate))}
+                     for source, target, rate in zip(rows, cols, rates)]
+            with open(os.path.join(directory, filename), 'w') as fp:
+                json.dump({'nodes': nodes, 'links': links}, fp,
+                          separators=(',', ':'))
+            levels.append({'file': filename, 'nodes': len(nodes),
+                           'links': len(links)})
+        with open(os.path.join(directory, u'index.json'), 'w') as fp:
+            json.dump({'size': self.SIZE, 'levels': levels}, fp, indent=1)
+        return levels
+
+    @staticmethod
+    def read_positions(directory):
+        """Return {id: (x, y)} of the export in directory, if any."""
+        try:
+            with open(os.path.join(directory, u'index.json')) as fp:
+                levels = json.load(fp)['levels']
+            with open(os.path.join(directory, levels[-1]['file'])) as fp:
+                nodes = json.load(fp)['nodes']
+        except (IOError, OSError, ValueError, KeyError, IndexError):
+            return {}
+        return dict((node['id'], (node['x'], node['y'])) for node in nodes)
+
+
+def normalize_name(name):
+    """Normalize an artist name for comparison.
+
+    Applies Unicode NFKC normalization, case folding and collapses
+    whitespace, so "Sigur Rós", "SIGUR  RÓS" and the decomposed form of
+    the accent compare equal.
+    """
+    return u' '.join(unicodedata.normalize('NFKC', name).casefold().split())
+
+
+class LibraryIndex():
+    """Artists of the beets library indexed by name and mbid.
+
+    Built in one pass over the library and reused for the whole crawl.
+    A similar artist is owned if its normalized name (see
+    ``normalize_name``) equals the artist or album artist of an item.
+    There is no substring or fuzzy matching: "Nick Cave" does not own
+    "Nick Cave & The Bad Seeds".
+    """
+
+    def __init__(self, lib):
+        """Constructor of class."""
+        self._names = set()
+        self._by_mbid = {}
+        with lib.transaction() as tx:
+            rows = tx.query('SELECT DISTINCT artist, albumartist, '
+                            'mb_artistid, mb_albumartistid FROM items')
+        for artist, albumartist, mb_artistid, mb_albumartistid in rows:
+            for name, mbid in ((artist, mb_artistid),
+                               (albumartist, mb_albumartistid)):
+                if name:
+                    self._names.add(normalize_name(name))
+                    if mbid:
+                        self._by_mbid.setdefault(mbid, name)
+
+    def __len__(self):
+        """Return number of distinct artist names."""
+        return len(self._names)
+
+    def owns(self, name):
+        """Check whether an artist of this name is in the library."""
+        return normalize_name(name) in self._names
+
+    def name(self, mbid):
+        """Return the library name of the artist with mbid or None."""
+        return self._by_mbid.get(mbid)
+
+
+class Relation():
+    """Relations between Artists.
+
+    Stored relations live in the arrays of a RelationStore; a Relation
+    is the small value object passed in and handed out by it.
+    """
+
+    __slots__ = ('source_mbid', 'target_mbid', 'source_lastfmurl',
+                 'target_lastfmurl', 'rate', 'fetched')
+
+    def __init__(self, source_mbid, target_mbid, source_lastfmurl,
+                 target_lastfmurl, rate, fetched=0):
+        """Constructor of class."""
+        self.source_mbid = source_mbid
+        self.target_mbid = target_mbid
+        self.source_lastfmurl = source_lastfmurl
+        self.target_lastfmurl = target_lastfmurl
+        self.rate = rate
+        self.fetched = fetched
+
+    def __eq__(self, other):
+        """Override the default Equals behavior."""
+        s = False
+        t = False
+        st = False
+
+        if isinstance(other, self.__class__):
+
+            if self.source_mbid and other.source_mbid:
+                if self.source_mbid == other.source_mbid:
+                    s = True
+            else:
+                if self.source_lastfmurl and other.source_lastfmurl:
+                    if self.source_lastfmurl == other.source_lastfmurl:
+                        s = True
+
+            if self.target_mbid and other.target_mbid:
+                if self.target_mbid == other.target_mbid:
+                    t = True
+            else:
+                if self.target_lastfmurl and other.target_lastfmurl:
+                    if self.target_lastfmurl == other.target_lastfmurl:
+                        t = True
+
+            if self.source_mbid and other.target_mbid:
+                if self.source_mbid == other.target_mbid:
+                    st = True
+            else:
+                if self.source_lastfmurl and other.target_lastfmurl:
+                    if self.source_lastfmurl == other.target_lastfmurl:
+                        st = True
+
+            if self.target_mbid and other.source_mbid:
+                if self.target_mbid == other.source_mbid:
+                    st = True
+            else:
+                if self.target_lastfmurl and other.source_lastfmurl:
+                    if self.target_lastfmurl == other.source_lastfmurl:
+                        st = True
+
+        if s and t or st:
+            return True
+        else:
+            return False
+
+    def __ne__(self, other):
+        """Define a non-equality test."""
+        if isinstance(other, self.__class__):
+            return not self.__eq__(other)
+
+    def __getitem__(self, key):
+        """Define a getitem function."""
+        if key in self.__slots__:
+            return getattr(self, key)
+        return None
+
+    def tojson(self):
+        """Define a setitem function."""
+        return json.dumps(self, default=slot_dict, sort_keys=True, indent=4)
+
+
+class CrawlState():
+    """Progress of a crawl, kept in SQLite next to the graph file.
+
+    Stores the depth limit of the crawl and whether it finished and, for
+    every artist that was queued or fetched, its status (``pending``,
+    ``done`` or ``failed``), the number of failed fetches, its level
+    (distance from the seeds plus one), its priority score and when it
+    last changed. Rows are held in memory and written on ``flush``,
+    which the crawl calls with every journal checkpoint.
+    """
+
+    COLUMNS = ('status', 'retries', 'level', 'score', 'updated')
+
+    def __init__(self, path):
+        """Constructor of class."""
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS artists ('
+                         'identity TEXT PRIMARY KEY, status TEXT, '
+                         'retries INTEGER, level INTEGER, updated REAL, '
+                         'score REAL DEFAULT 1.0)')
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(artists)')]
+        if 'score' not in columns:
+            self._db.execute('ALTER TABLE artists '
+                             'ADD COLUMN score REAL DEFAULT 1.0')
+        self._db.execute('CREATE TABLE IF NOT EXISTS crawl ('
+                         'key TEXT PRIMARY KEY, value)')
+        self._artists = dict(
+            (row[0], list(row[1:])) for row in
+            self._db.execute('SELECT identity, {} FROM artists'.format(
+                u', '.join(self.COLUMNS))))
+        meta = dict(self._db.execute('SELECT key, value FROM crawl'))
+        self.max_depth = meta.get('max_depth', 0)
+        self.finished = bool(meta.get('finished', True))
+        self.updated = meta.get('updated')
+        self._dirty = set()
+
+    def start(self, max_depth):
+        """Begin a new crawl; pending artists start over as seeds."""
+        self.max_depth = max_depth
+        self.finished = False
+        for identity, row in self._artists.items():
+            if row[0] == 'pending':
+                row[2] = 1
+                row[3] = 1.0
+                self._dirty.add(identity)
+
+    def finish(self):
+        """Mark the crawl as complete."""
+        self.finished = True
+
+    def status(self, identity):
+        """Return (status, retries, level, score, updated) of an artist
+        or None.
+        """
+        row = self._artists.get(identity)
+        return tuple(row) if row else None
+
+    def runnable(self, identity):
+        """Check whether an artist may still be fetched."""
+        row = self._artists.get(identity)
+        return row is None or row[0] != 'failed'
+
+    def position(self, identity):
+        """Return (level, score) of an artist, seeds are (1, 1.0)."""
+        row = self._artists.get(identity)
+        return (row[2], row[3]) if row else (1, 1.0)
+
+    def add(self, identity, level, score=1.0):
+        """Queue an artist, or raise the score of a queued one."""
+        row = self._artists.get(identity)
+        if row is None:
+            self._set(identity, ['pending', 0, level, score, time.time()])
+        elif row[0] == 'pending' and score > row[3]:
+            self._set(identity, ['pending', row[1], level, score,
+                                 time.time()])
+
+    def done(self, identity):
+        """Record a successful fetch."""
+        row = self._artists.get(identity) or ['pending', 0, 1, 1.0, 0]
+        self._set(identity, ['done', row[1], row[2], row[3], time.time()])
+
+    def fail(self, identity, limit):
+        """Record a failed fetch; return True when retries are used up."""
+        row = self._artists.get(identity) or ['pending', 0, 1, 1.0, 0]
+        retries = row[1] + 1
+        failed = retries >= limit
+        self._set(identity, ['failed' if failed else 'pending', retries,
+                             row[2], row[3], time.time()])
+        return failed
+
+    def counts(self):
+        """Return the number of artists per status."""
+        counts = {}
+        for row in self._artists.values():
+            counts[row[0]] = counts.get(row[0], 0) + 1
+        return counts
+
+    def _set(self, identity, row):
+        self._artists[identity] = row
+        self._dirty.add(identity)
+
+    def flush(self):
+        """Write changed rows and the crawl position to disk."""
+        self.updated = time.time()
+        self._db.executemany(
+            'INSERT OR REPLACE INTO artists (identity, {}) '
+            'VALUES (?, ?, ?, ?, ?, ?)'.format(u', '.join(self.COLUMNS)),
+            [[identity] + self._artists[identity]
+             for identity in self._dirty])
+        self._dirty.clear()
+        self._db.executemany(
+            'INSERT OR REPLACE INTO crawl VALUES (?, ?)',
+            [('max_depth', self.max_depth),
+             ('finished', int(self.finished)), ('updated', self.updated)])
+        self._db.commit()
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self._db.close()
+
+    def remove(self):
+        """Close and delete the state, e.g. when the graph is refetched."""
+        self._db.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class CrawlQueue():
+    """Priority queue of owned artists waiting to be expanded.
+
+    Pops the artist with the highest score first, ties in order of
+    level and then of insertion, so with equal scores the crawl is
+    breadth first. Pushing a queued artist again with a higher score
+    moves it up; the outdated entry is skipped when it comes up.
+    """
+
+    def __init__(self):
+        """Constructor of class."""
+        self._heap = []
+        self._best = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        """Return number of queued artists."""
+        return len(self._best)
+
+    def push(self, artist, level, score):
+        """Queue artist, or raise its score."""
+        identity = artist_identity(artist)
+        if score <= self._best.get(identity, (-1.0,))[0]:
+            return
+        self._best[identity] = (score, level)
+        heapq.heappush(self._heap, (-score, level, next(self._counter),
+                                    identity, artist))
+
+    def pop(self):
+        """Return (artist, level, score) of the best artist or None."""
+        while self._heap:
+            score, level, _, identity, artist = heapq.heappop(self._heap)
+            if self._best.get(identity) == (-score, level):
+                del self._best[identity]
+                return artist, level, -score
+        return None
+
+
+class GraphJournal():
+    """Append-only checkpoint log of new and changed nodes and edges.
+
+    Entries are buffered and written as json lines on ``flush``, which
+    the crawl calls every ``checkpoint`` expanded artists and when it
+    stops, so an interrupted run loses at most the artists expanded
+    since the last checkpoint. ``import_graph`` replays the journal on
+    top of the compacted json file.
+    """
+
+    def __init__(self, path):
+        """Constructor of class."""
+        self.path = path
+        self._pending = []
+
+    def exists(self):
+        """Check whether a journal was written."""
+        return os.path.isfile(self.path)
+
+    def add_node(self, nid, attrs):
+        """Buffer a node entry."""
+        self._pending.append({'node': dict(attrs, id=nid)})
+
+    def add_edge(self, source, target, attrs):
+        """Buffer an edge entry."""
+        self._pending.append({'edge': dict(attrs, source=source,
+                                           target=target)})
+
+    def add_rename(self, old, new):
+        """Buffer the change of a node id from old to the mbid new."""
+        self._pending.append({'rename': {'old': old, 'new': new}})
+
+    def flush(self):
+        """Append buffered entries to the journal file."""
+        if not self._pending:
+            return
+        with open(self.path, 'a') as fp:
+            for entry in self._pending:
+                fp.write(json.dumps(entry) + u'\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        del self._pending[:]
+
+    def replay(self):
+        """Yield (kind, record) for every complete journal entry."""
+        if not self.exists():
+            return
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of a run that died while writing
+                    break
+                for kind, record in entry.items():
+                    yield kind, record
+
+    def apply(self, nodes, links):
+        """Append the journal records to nodes and links.
+
+        Renamed ids are replaced in all records, including those of the
+        compacted file already in nodes and links.
+        """
+        renames = {}
+        for kind, record in self.replay():
+            if kind == 'node':
+                nodes.append(record)
+            elif kind == 'edge':
+                links.append(record)
+            elif kind == 'rename':
+                renames[record['old']] = record['new']
+        if not renames:
+            return
+        for attrs in nodes:
+            new = renames.get(attrs['id'])
+            if new is not None:
+                attrs['id'] = attrs['mbid'] = new
+        for attrs in links:
+            for end, prefix in (('source', 's'), ('target', 't')):
+                new = renames.get(attrs[end])
+                if new is not None:
+                    attrs[end] = attrs[prefix + 'mbid'] = new
+
+    def remove(self):
+        """Drop the journal, e.g. after compaction."""
+        del self._pending[:]
+        if self.exists():
+            os.remove(self.path)
+
+
+class ImportQueue():
+    """Album artists imported since the similarity graph was updated.
+
+    The import listeners append one json line per album or item, which
+    costs no request; ``--drain`` reads them back without duplicates and
+    clears the file once they are crawled.
+    """
+
+    def __init__(self, path):
+        """Constructor of class."""
+        self.path = path
+
+    def add(self, mbid, name):
+        """Queue the artist with mbid and name."""
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps({'mbid': mbid, 'name': name}) + u'\n')
+
+    def items(self):
+        """Return the queued artists as items for collect_artists."""
+        if not os.path.isfile(self.path):
+            return []
+        artists = {}
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                artists[entry['mbid']] = entry['name']
+        return [{'mb_albumartistid': mbid, 'albumartist': name}
+                for mbid, name in artists.items()]
+
+    def clear(self):
+        """Forget the queued artists."""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class LastfmClient():
+    """last.fm web service client for the calls of the crawl.
+
+    Sends json requests over one keep-alive ``requests`` session, so the
+    workers reuse pooled connections instead of opening one per request
+    like pylast does. Failures raise the pylast exceptions the plugin
+    already handles: ``WSError`` for an error last.fm reports and
+    ``NetworkError`` for everything else.
+    """
+
+    TIMEOUT = 30
+
+    def __init__(self, api_key, url=LASTFM_URL, pool=16):
+        """Constructor of class."""
+        import requests
+        self.api_key = api_key
+        self.url = url
+        self._requests = requests
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool)
+        self._session.mount(u'https://', adapter)
+        self._session.mount(u'http://', adapter)
+
+    def call(self, method, **params):
+        """Send one request and return the decoded answer."""
+        import pylast
+        params.update(method=method, api_key=self.api_key, format=u'json')
+        try:
+            response = self._session.get(self.url, params=params,
+                                         timeout=self.TIMEOUT)
+        except self._requests.RequestException as exc:
+            raise pylast.NetworkError(None, exc)
+        try:
+            document = response.json()
+        except ValueError:
+            document = None
+        if isinstance(document, dict) and u'error' in document:
+            raise pylast.WSError(None, str(document[u'error']),
+                                 document.get(u'message', u''))
+        if response.status_code != 200 or not isinstance(document, dict):
+            raise pylast.NetworkError(None, u'HTTP {} from {}'.format(
+                response.status_code, method))
+        return document
+
+    def similar(self, limit, mbid=None, name=None):
+        """Return (url, similar) of an artist, by mbid or else by name.
+
+        One ``artist.getSimilar`` request answers both: url is the
+        last.fm url of the artist and similar a list of (mbid, name,
+        lastfmurl, match) tuples of up to limit similar artists.
+        """
+        if mbid:
+            document = self.call(u'artist.getSimilar', mbid=mbid,
+                                 limit=limit)
+        else:
+            document = self.call(u'artist.getSimilar', artist=name,
+                                 limit=limit)
+        document = document.get(u'similarartists') or {}
+        entries = document.get(u'artist') or []
+        if isinstance(entries, dict):
+            # a single similar artist is not wrapped in a list
+            entries = [entries]
+        similar = [(entry.get(u'mbid') or u'', entry[u'name'],
+                    lastfm_url(entry[u'name']), float(entry[u'match']))
+                   for entry in entries]
+        name = (document.get(u'@attr') or {}).get(u'artist') or name
+        return (lastfm_url(name) if name else u''), similar
+
+
+class RateLimiter():
+    """Token bucket shared by all threads talking to one web service.
+
+    ``rate`` is the number of requests per second, ``burst`` how many
+    may be sent at once after an idle period. A rate of 0 disables the
+    limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        """Constructor of class."""
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the next request may be sent."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._stamp) * self.rate)
+            self._stamp = now
+            # reserve a token, a negative balance is the queue length
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Metrics():
+    """Counters, latencies and errors of one run of the plugin.
+
+    ``timer`` measures a block under a name, like a last.fm request or
+    a whole phase of the crawl; every duration is kept, so ``summary``
+    can report percentiles. ``error`` counts exceptions by type. Safe
+    to share between the worker threads.
+    """
+
+    def __init__(self):
+        """Constructor of class."""
+        self.started = time.time()
+        self._timers = {}
+        self._errors = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        """Measure the time the with block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._timers.setdefault(name, array('d')).append(elapsed)
+
+    def error(self, name, exc):
+        """Count exc as an error of name."""
+        with self._lock:
+            errors = self._errors.setdefault(name, {})
+            kind = type(exc).__name__
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def count(self, name, value=1):
+        """Add value to the counter name."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_cache(self, stats):
+        """Count the hits and misses of ResponseCache.stats()."""
+        for endpoint, hits, misses in stats:
+            self.count(u'cache {} hits'.format(endpoint), hits)
+            self.count(u'cache {} misses'.format(endpoint), misses)
+
+    @staticmethod
+    def percentile(ordered, share):
+        """Return the share (0..1) percentile of sorted values."""
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+    def summary(self):
+        """Return the metrics as a json serializable dict."""
+        with self._lock:
+            timers = {}
+            for name, values in self._timers.items():
+                ordered = sorted(values)
+                timers[name] = {'count': len(ordered),
+                                'total': sum(ordered),
+                                'p50': self.percentile(ordered, 0.5),
+                                'p90': self.percentile(ordered, 0.9),
+                                'p99': self.percentile(ordered, 0.99),
+                                'max': ordered[-1]}
+            return {'started': self.started,
+                    'seconds': time.time() - self.started,
+                    'timers': timers,
+                    'errors': dict((name, dict(errors)) for name, errors
+                                   in self._errors.items()),
+                    'counters': dict(self._counters)}
+
+    def table(self):
+        """Return the summary as lines of a table."""
+        summary = self.summary()
+        lines = [u'{:<14} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            u'timer', u'count', u'total [s]', u'p50 [ms]', u'p90 [ms]',
+            u'p99 [ms]')]
+        for name, timer in sorted(summary['timers'].items()):
+            lines.append(u'{:<14} {:>7} {:>9.2f} {:>9.1f} {:>9.1f} '
+                         u'{:>9.1f}'.format(name, timer['count'],
+                                            timer['total'],
+                                            timer['p50'] * 1000,
+                                            timer['p90'] * 1000,
+                                            timer['p99'] * 1000))
+        counters = summary['counters']
+        for name in sorted(counters):
+            if name.endswith(u' hits'):
+                endpoint = name[:-len(u' hits')]
+                total = counters[name] + counters.get(
+                    endpoint + u' misses', 0)
+                lines.append(u'{}: {} hits of {} ({:.0%})'.format(
+                    endpoint, counters[name], total,
+                    counters[name] / total if total else 0))
+            elif not name.endswith(u' misses'):
+                lines.append(u'{}: {}'.format(name, counters[name]))
+        for name, errors in sorted(summary['errors'].items()):
+            for kind, count in sorted(errors.items()):
+                lines.append(u'{} errors: {} {}'.format(name, count, kind))
+        return lines
+
+    def write(self, path):
+        """Append the summary as one json line to path."""
+        with open(path, 'a') as fp:
+            fp.write(json.dumps(self.summary(), sort_keys=True) + u'\n')
+
+
+class ResponseCache():
+    """Persistent cache of last.fm and MusicBrainz answers in SQLite.
+
+    Entries are keyed by endpoint and argument and expire after the TTL
+    of their endpoint in seconds; a cached None is a negative answer and
+    uses the ``notfound`` TTL. When more than ``size`` entries are
+    stored the least recently used ones are evicted. Safe to share
+    between the worker threads and between processes, e.g. shards
+    crawling in parallel: the file is in WAL mode and every write is
+    committed right away, and when another process holds the lock for
+    longer than TIMEOUT a lookup counts as a miss and a write is
+    skipped.
+    """
+
+    TIMEOUT = 2
+
+    def __init__(self, path, size, ttl):
+        """Constructor of class."""
+        self.size = size
+        self.ttl = ttl
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=self.TIMEOUT,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'endpoint TEXT, key TEXT, value TEXT, '
+                         'stored REAL, used REAL, '
+                         'PRIMARY KEY (endpoint, key))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_used '
+                         'ON responses (used)')
+        self._count = self._db.execute(
+            'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def get(self, endpoint, key):
+        """Return (hit, value) for the entry of endpoint and key."""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    'SELECT value, stored FROM responses '
+                    'WHERE endpoint = ? AND key = ?',
+                    (endpoint, key)).fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            if row is not None:
+                value = json.loads(row[0])
+                ttl = self.ttl.get(endpoint if value is not None
+                                   else 'notfound', 0)
+                if now - row[1] < ttl:
+                    try:
+                        self._db.execute(
+                            'UPDATE responses SET used = ? '
+                            'WHERE endpoint = ? AND key = ?',
+                            (now, endpoint, key))
+                    except sqlite3.OperationalError:
+                        # still a hit, only its eviction order is stale
+                        pass
+                    self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+                    return True, value
+            self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+        return False, None
+
+    def put(self, endpoint, key, value):
+        """Store value as the answer of endpoint and key."""
+        now = time.time()
+        with self._lock:
+            try:
+                self._put(endpoint, key, value, now)
+            except sqlite3.OperationalError:
+                # locked by another process, the answer is fetched again
+                pass
+
+    def _put(self, endpoint, key, value, now):
+        """Store value, the cache lock held."""
+        cursor = self._db.execute(
+            'UPDATE responses SET value = ?, stored = ?, used = ? '
+            'WHERE endpoint = ? AND key = ?',
+            (json.dumps(value), now, now, endpoint, key))
+        if cursor.rowcount:
+            return
+        self._db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?)',
+                         (endpoint, key, json.dumps(value), now, now))
+        self._count += 1
+        if self._count > self.size:
+            # evict a tenth at once, not one row per insert
+            evict = self._count - self.size + self.size // 10
+            self._db.execute(
+                'DELETE FROM responses WHERE rowid IN ('
+                'SELECT rowid FROM responses ORDER BY used LIMIT ?)',
+                (evict,))
+            self._count = self._db.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def stats(self):
+        """Return (endpoint, hits, misses) for every endpoint used."""
+        return [(endpoint, self.hits.get(endpoint, 0),
+                 self.misses.get(endpoint, 0))
+                for endpoint in sorted(set(self.hits) | set(self.misses))]
+
+    def flush(self):
+        """Commit stored entries to disk; writes are committed already."""
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        self.flush()
+        self._db.close()
+
+
+class MbidResolver():
+    """Background MusicBrainz lookup of artist names.
+
+    Names are queued once each and searched one at a time on a daemon
+    thread, paced to MusicBrainz' limit of one request per second.
+    Answers, including "no match" as u'', are memoized in the
+    ``mbid`` entries of the response cache, so a name is searched once
+    per cache TTL. ``completed`` hands out finished lookups without
+    blocking.
+    """
+
+    def __init__(self, search, cache=None, log=None, rate=1):
+        """Constructor of class."""
+        self._search = search
+        self._cache = cache
+        self._log = log
+        self._limiter = RateLimiter(rate)
+        self._todo = Queue()
+        self._done = Queue()
+        self._seen = set()
+        self._thread = None
+        self._queued = 0
+        self._finished = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def submit(self, name):
+        """Queue name for lookup unless it was submitted before."""
+        if name in self._seen:
+            return
+        self._seen.add(name)
+        if self._cache:
+            hit, mbid = self._cache.get(u'mbid', name)
+            if hit:
+                self._done.put((name, mbid or u''))
+                return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queued += 1
+        self._todo.put(name)
+
+    def completed(self):
+        """Return the (name, mbid) pairs resolved since the last call."""
+        done = []
+        while True:
+            try:
+                done.append(self._done.get_nowait())
+            except Empty:
+                return done
+
+    def close(self, timeout=None):
+        """Wait up to timeout seconds for queued lookups to finish.
+
+        Returns the number of names left unresolved.
+        """
+        if self._thread is not None:
+            self._todo.put(None)
+            self._thread.join(timeout)
+            # a late answer must not reach the cache once it is closed
+            with self._lock:
+                self._stopped = True
+            self._thread = None
+        return self._queued - self._finished
+
+    def _run(self):
+        """Search queued names until close."""
+        while True:
+            name = self._todo.get()
+            if name is None:
+                return
+            self._limiter.acquire()
+            try:
+                mbid = self._search(name)
+            except Exception as exc:
+                # not memoized, the next crawl asks again
+                if self._log:
+                    self._log.debug(u'musicbrainz error: {0}', exc)
+                continue
+            with self._lock:
+                if self._stopped:
+                    return
+                if self._cache:
+                    self._cache.put(u'mbid', name, mbid)
+                self._finished += 1
+                self._done.put((name, mbid))
+
+
+class ArtistIds():
+    """Dense integer ids for artist identities.
+
+    The identity of an artist is its mbid, or its last.fm url when the
+    mbid is missing. Ids count up from 0 in order of first appearance;
+    the mbid and url of each id are kept in parallel lists.
+    """
+
+    def __init__(self):
+        """Constructor of class."""
+        self._ids = {}
+        self.mbids = []
+        self.lastfmurls = []
+
+    def __len__(self):
+        """Return number of interned artists."""
+        return len(self.mbids)
+
+    def get(self, identity):
+        """Return the id of identity or None."""
+        return self._ids.get(identity)
+
+    def intern(self, mbid, lastfmurl):
+        """Return the id of the artist, assigning a new one if needed."""
+        identity = mbid or lastfmurl
+        aid = self._ids.get(identity)
+        if aid is None:
+            aid = self._ids[identity] = len(self.mbids)
+            self.mbids.append(mbid)
+            self.lastfmurls.append(lastfmurl)
+        return aid
+
+    def rename(self, old, mbid):
+        """Let the artist of identity old be known by mbid as well."""
+        aid = self._ids.get(old)
+        if aid is not None:
+            self._ids[mbid] = aid
+            self.mbids[aid] = mbid
+
+    def clear(self):
+        """Forget all ids."""
+        self._ids.clear()
+        del self.mbids[:]
+        del self.lastfmurls[:]
+
+
+class RelationStore():
+    """Similarity relations deduplicated on the unordered artist pair.
+
+    A relation is keyed by the identities (mbid, or last.fm url when the
+    mbid is missing) of both artists in canonical order, so A->B and B->A
+    share one entry. The ``policy`` decides which rate a repeated pair
+    keeps: ``max`` keeps the highest, ``latest`` the most recent one.
+
+    Artists are interned to ArtistIds and every relation is one row of
+    the typed arrays ``source``, ``target``, ``rate`` and ``fetched``
+    (when last.fm last listed the pair, in epoch seconds). Relation
+    objects are only built when a relation is handed out.
+    """
+
+    POLICIES = ('max', 'latest')
+
+    def __init__(self, policy='max'):
+        """Constructor of class."""
+        if policy not in self.POLICIES:
+            raise ValueError(u'unknown rate policy: {}'.format(policy))
+        self.policy = policy
+        self.ids = ArtistIds()
+        self.source = array('i')
+        self.target = array('i')
+        self.rate = array('d')
+        self.fetched = array('I')
+        self._rows = {}
+
+    def __len__(self):
+        """Return number of unique relations."""
+        return len(self.rate)
+
+    def __iter__(self):
+        """Iterate over relations in insertion order."""
+        for row in range(len(self.rate)):
+            yield self.relation(row)
+
+    def __contains__(self, relation):
+        """Check whether the artist pair of relation is stored."""
+        source = self.ids.get(artist_identity(relation, u'source_'))
+        target = self.ids.get(artist_identity(relation, u'target_'))
+        if source is None or target is None:
+            return False
+        return self.key(source, target) in self._rows
+
+    @staticmethod
+    def key(source, target):
+        """Return the canonical key of a pair of artist ids."""
+        if target < source:
+            source, target = target, source
+        return source << 32 | target
+
+    def relation(self, row):
+        """Return the relation stored in row."""
+        ids = self.ids
+        source = self.source[row]
+        target = self.target[row]
+        return Relation(ids.mbids[source], ids.mbids[target],
+                        ids.lastfmurls[source], ids.lastfmurls[target],
+                        self.rate[row], self.fetched[row])
+
+    def upsert(self, relation):
+        """Store relation or update the rate of the stored pair."""
+        source = self.ids.intern(relation['source_mbid'],
+                                 relation['source_lastfmurl'])
+        target = self.ids.intern(relation['target_mbid'],
+                                 relation['target_lastfmurl'])
+        key = self.key(source, target)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self.rate)
+            self.source.append(source)
+            self.target.append(target)
+            self.rate.append(relation['rate'])
+            self.fetched.append(relation['fetched'])
+            return self.relation(row)
+        if self.policy == 'latest' or relation['rate'] > self.rate[row]:
+            self.rate[row] = relation['rate']
+        self.fetched[row] = max(self.fetched[row], relation['fetched'])
+        return self.relation(row)
+
+    def rename(self, old, mbid):
+        """Let the artist of identity old be known by mbid."""
+        self.ids.rename(old, mbid)
+
+    def clear(self):
+        """Remove all relations."""
+        self.ids.clear()
+        self._rows.clear()
+        del self.source[:]
+        del self.target[:]
+        del self.rate[:]
+        del self.fetched[:]
+
+
+class ArtistNode():
+    """Artist Nodes."""
+
+    __slots__ = ('mbid', 'name', 'lastfmurl', 'owned', 'checked', 'group',
+                 'myname', 'fetched')
+
+    def __init__(self, mbid, name, lastfmurl, group=0, owned=False,
+                 checked=False):
         """Constructor of class."""
         self.mbid = mbid
         self.name = name
@@ -533,6 +3827,8 @@ class ArtistNode():
         self.checked = checked
         self.group = group
         self.lastfmurl = lastfmurl
+        self.myname = u'unknown'
+        self.fetched = 0
 
     def __eq__(self, other):
         """Override the default Equals behavior."""
@@ -550,44 +3846,370 @@ class ArtistNode():
 
     def __getitem__(self, key):
         """Define a getitem function."""
-        if key == 'mbid':
-            return self.mbid
-        elif key == 'name':
-            return self.name
-        elif key == 'owned':
-            return self.owned
-        elif key == 'checked':
-            return self.checked
-        elif key == 'group':
-            return self.group
-        elif key == 'lastfmurl':
-            return self.lastfmurl
-        elif key == 'myname':
-            return self.myname            
-        else:
-            return None
+        if key in self.__slots__:
+            return getattr(self, key)
+        return None
 
     def __setitem__(self, key, value):
         """Define a setitem function."""
-        if key == 'mbid':
-            self.mbid = value
-        elif key == 'name':
-            self.name = value
-        elif key == 'owned':
-            self.owned = value
-        elif key == 'checked':
-            self.checked = value
-        elif key == 'lastfmurl':
-            self.lastfmurl = value
-        elif key == 'group':
-            self.group = value
-        elif key == 'myname':
-            self.myname = value
+        if key in self.__slots__:
+            setattr(self, key, value)
 
     def tojson(self):
         """Define a setitem function."""
-        return json.dumps(self, default=lambda o: o.__dict__,
-                          sort_keys=True, indent=4)
+        return json.dumps(self, default=slot_dict, sort_keys=True, indent=4)
 
     def __str__(self):
         return(self.mbid + " " + self.name + " " + self.myname + " "+ str(self.owned) + " " + str(self.checked) + " " + str(self.group) + " " + self.lastfmurl)
+
+
+class ArtistRegistry():
+    """Collection of artist nodes indexed by mbid and last.fm url.
+
+    Membership follows ``ArtistNode.__eq__``: two nodes are the same
+    artist if both have an mbid and it matches, otherwise if both have
+    a last.fm url and it matches. Lookups and inserts are O(1).
+    """
+
+    def __init__(self, nodes=()):
+        """Constructor of class."""
+        self._nodes = []
+        self._by_mbid = {}
+        self._by_url = {}
+        self.extend(nodes)
+
+    def __len__(self):
+        """Return number of stored artists."""
+        return len(self._nodes)
+
+    def __iter__(self):
+        """Iterate over artists in insertion order."""
+        return iter(self._nodes)
+
+    def __contains__(self, node):
+        """Check whether an equal artist is already stored."""
+        return self.get(node) is not None
+
+    def get(self, node):
+        """Return the stored artist equal to node or None."""
+        mbid = node['mbid']
+        lastfmurl = node['lastfmurl']
+        if mbid:
+            found = self._by_mbid.get(mbid)
+            if found is not None:
+                return found
+        if lastfmurl:
+            for candidate in self._by_url.get(lastfmurl, ()):
+                # nodes which both carry an mbid only match by mbid
+                if not (mbid and candidate['mbid']):
+                    return candidate
+        return None
+
+    def append(self, node):
+        """Store an artist, like list.append."""
+        self._nodes.append(node)
+        self._index(node)
+
+    def extend(self, nodes):
+        """Store several artists, like list.extend."""
+        for node in nodes:
+            self.append(node)
+
+    def remove(self, node):
+        """Remove the stored artist node."""
+        for index, stored in enumerate(self._nodes):
+            if stored is node:
+                del self._nodes[index]
+                break
+        mbid = node['mbid']
+        if mbid and self._by_mbid.get(mbid) is node:
+            del self._by_mbid[mbid]
+        lastfmurl = node['lastfmurl']
+        bucket = [n for n in self._by_url.get(lastfmurl, ()) if n is not node]
+        if bucket:
+            self._by_url[lastfmurl] = bucket
+        else:
+            self._by_url.pop(lastfmurl, None)
+
+    def clear(self):
+        """Remove all artists."""
+        del self._nodes[:]
+        self._by_mbid.clear()
+        self._by_url.clear()
+
+    def set_mbid(self, node, mbid):
+        """Backfill the mbid of a stored artist and reindex it."""
+        old = node['mbid']
+        if old and self._by_mbid.get(old) is node:
+            del self._by_mbid[old]
+        node['mbid'] = mbid
+        self._index(node)
+
+    def set_lastfmurl(self, node, lastfmurl):
+        """Update the last.fm url of a stored artist and reindex it."""
+        old = node['lastfmurl']
+        if old in self._by_url:
+            bucket = [n for n in self._by_url[old] if n is not node]
+            if bucket:
+                self._by_url[old] = bucket
+            else:
+                del self._by_url[old]
+        node['lastfmurl'] = lastfmurl
+        self._index(node)
+
+    def _index(self, node):
+        """Add node to the lookup tables."""
+        mbid = node['mbid']
+        if mbid:
+            self._by_mbid.setdefault(mbid, node)
+        lastfmurl = node['lastfmurl']
+        if lastfmurl:
+            bucket = self._by_url.setdefault(lastfmurl, [])
+            if not any(n is node for n in bucket):
+                bucket.append(node)
+
+
+def memory_usage():
+    """Return (current, peak) resident memory of this process in MB.
+
+    The current size comes from /proc; where that is missing the peak
+    is returned for both.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes, but bytes on macOS
+        peak /= 1048576 if sys.platform == 'darwin' else 1024
+    except ImportError:
+        peak = 0
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        current = pages * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (IOError, OSError, ValueError, IndexError):
+        current = peak
+    return current, max(peak, current)
+
+
+class SpillStore():
+    """On-disk store of the foreign artists and relations of a crawl.
+
+    Used once a crawl outgrows ``max_memory``: ``artists`` takes the
+    place of the registry of foreign artists and ``relations`` the place
+    of the RelationStore, with rows in a SQLite file instead of objects
+    in memory. The file is scratch space, the journal is what survives
+    an interrupted run; writes are committed on ``flush``.
+    """
+
+    def __init__(self, path, policy='max'):
+        """Constructor of class."""
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE artists ('
+                         'id TEXT PRIMARY KEY, mbid TEXT, lastfmurl TEXT, '
+                         'name TEXT, myname TEXT, grp INTEGER, '
+                         'checked INTEGER, fetched INTEGER)')
+        self._db.execute('CREATE INDEX artists_mbid ON artists (mbid)')
+        self._db.execute('CREATE INDEX artists_url ON artists (lastfmurl)')
+        self._db.execute('CREATE TABLE relations ('
+                         'lo TEXT, hi TEXT, smbid TEXT, tmbid TEXT, '
+                         'slastfmurl TEXT, tlastfmurl TEXT, rate REAL, '
+                         'fetched INTEGER, PRIMARY KEY (lo, hi))')
+        self._db.execute('CREATE INDEX relations_hi ON relations (hi)')
+        self.artists = SpilledArtists(self._db)
+        self.relations = SpilledRelations(self._db, policy)
+
+    def flush(self):
+        """Commit the pending writes."""
+        self._db.commit()
+
+    def remove(self):
+        """Close and delete the store."""
+        self._db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SpilledArtists():
+    """ArtistRegistry of a SpillStore, for foreign artists.
+
+    Lookups follow ``ArtistNode.__eq__`` like the registry's. Artists
+    are rebuilt from their row on every lookup, so a change to a
+    returned artist is kept by passing it to ``append`` again.
+    """
+
+    COLUMNS = u'mbid, lastfmurl, name, myname, grp, checked, fetched'
+
+    def __init__(self, db):
+        """Constructor of class."""
+        self._db = db
+
+    def __len__(self):
+        """Return number of stored artists."""
+        return self._db.execute('SELECT COUNT(*) FROM artists').fetchone()[0]
+
+    def __iter__(self):
+        """Iterate over artists in insertion order."""
+        cursor = self._db.execute('SELECT {} FROM artists ORDER BY rowid'
+                                  .format(self.COLUMNS))
+        for row in cursor:
+            yield self.node(row)
+
+    def __contains__(self, node):
+        """Check whether an equal artist is stored."""
+        return self.get(node) is not None
+
+    @staticmethod
+    def node(row):
+        """Return the ArtistNode of a row."""
+        mbid, lastfmurl, name, myname, group, checked, fetched = row
+        node = ArtistNode(mbid, name, lastfmurl, group, group == 1,
+                          bool(checked))
+        node['myname'] = myname
+        node['fetched'] = fetched
+        return node
+
+    def get(self, node):
+        """Return the stored artist equal to node or None."""
+        mbid = node['mbid']
+        lastfmurl = node['lastfmurl']
+        row = None
+        if mbid:
+            row = self._db.execute('SELECT {} FROM artists WHERE mbid = ? '
+                                   'LIMIT 1'.format(self.COLUMNS),
+                                   (mbid,)).fetchone()
+        if row is None and lastfmurl:
+            # nodes which both carry an mbid only match by mbid
+            row = self._db.execute('SELECT {} FROM artists WHERE '
+                                   'lastfmurl = ? AND (? = \'\' OR '
+                                   'mbid = \'\') ORDER BY rowid LIMIT 1'
+                                   .format(self.COLUMNS),
+                                   (lastfmurl, mbid)).fetchone()
+        return None if row is None else self.node(row)
+
+    def append(self, node):
+        """Store an artist or update the stored one."""
+        self._db.execute('INSERT OR REPLACE INTO artists (id, {}) VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?, ?)'.format(self.COLUMNS),
+                         (artist_identity(node), node['mbid'],
+                          node['lastfmurl'], node['name'], node['myname'],
+                          node['group'], int(bool(node['checked'])),
+                          node['fetched']))
+
+    def extend(self, nodes):
+        """Store several artists."""
+        for node in nodes:
+            self.append(node)
+
+    def remove(self, node):
+        """Remove the stored artist node."""
+        self._db.execute('DELETE FROM artists WHERE id = ?',
+                         (artist_identity(node),))
+
+    def set_mbid(self, node, mbid):
+        """Backfill the mbid of a stored artist."""
+        old = artist_identity(node)
+        node['mbid'] = mbid
+        self._db.execute('UPDATE artists SET id = ?, mbid = ? WHERE id = ?',
+                         (mbid, mbid, old))
+
+    def record(self, nid):
+        """Return the graph node record of identity nid or None."""
+        row = self._db.execute('SELECT {} FROM artists WHERE id = ?'
+                               .format(self.COLUMNS), (nid,)).fetchone()
+        if row is None:
+            return None
+        return dict(node_attrs(self.node(row)), id=nid)
+
+    def records(self):
+        """Yield the graph node records of all artists."""
+        for node in self:
+            yield dict(node_attrs(node), id=artist_identity(node))
+
+
+class SpilledRelations():
+    """RelationStore of a SpillStore.
+
+    A pair of artists is one row keyed by both identities in sorted
+    order; ``policy`` decides which rate a repeated pair keeps, like in
+    the RelationStore.
+    """
+
+    COLUMNS = u'smbid, tmbid, slastfmurl, tlastfmurl, rate, fetched'
+
+    def __init__(self, db, policy='max'):
+        """Constructor of class."""
+        if policy not in RelationStore.POLICIES:
+            raise ValueError(u'unknown rate policy: {}'.format(policy))
+        self._db = db
+        self.policy = policy
+
+    def __len__(self):
+        """Return number of unique relations."""
+        return self._db.execute(
+            'SELECT COUNT(*) FROM relations').fetchone()[0]
+
+    def __iter__(self):
+        """Iterate over relations in insertion order."""
+        cursor = self._db.execute('SELECT {} FROM relations ORDER BY rowid'
+                                  .format(self.COLUMNS))
+        for row in cursor:
+            yield Relation(*row)
+
+    @staticmethod
+    def key(relation):
+        """Return the sorted identities of the pair of relation."""
+        return tuple(sorted((artist_identity(relation, u'source_'),
+                             artist_identity(relation, u'target_'))))
+
+    def upsert(self, relation):
+        """Store relation or update the rate of the stored pair."""
+        key = self.key(relation)
+        self._db.execute(
+            'INSERT INTO relations (lo, hi, {}) VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (lo, hi) DO UPDATE SET '
+            'rate = CASE WHEN ? OR excluded.rate > rate THEN excluded.rate '
+            'ELSE rate END, fetched = max(fetched, excluded.fetched)'
+            .format(self.COLUMNS),
+            key + (relation['source_mbid'], relation['target_mbid'],
+                   relation['source_lastfmurl'],
+                   relation['target_lastfmurl'], relation['rate'],
+                   relation['fetched'], self.policy == 'latest'))
+        return Relation(*self._db.execute(
+            'SELECT {} FROM relations WHERE lo = ? AND hi = ?'
+            .format(self.COLUMNS), key).fetchone())
+
+    def around(self, identity):
+        """Return the relations of the artist identity."""
+        return [Relation(*row) for row in self._db.execute(
+            'SELECT {} FROM relations WHERE lo = ? UNION ALL '
+            'SELECT {} FROM relations WHERE hi = ?'.format(
+                self.COLUMNS, self.COLUMNS), (identity, identity))]
+
+    def degree(self, identity):
+        """Return the number of relations of the artist identity."""
+        return self._db.execute(
+            'SELECT (SELECT COUNT(*) FROM relations WHERE lo = ?) + '
+            '(SELECT COUNT(*) FROM relations WHERE hi = ?)',
+            (identity, identity)).fetchone()[0]
+
+    def rename(self, old, mbid):
+        """Let the artist of identity old be known by mbid."""
+        for relation in self.around(old):
+            self._db.execute('DELETE FROM relations WHERE lo = ? AND hi = ?',
+                             self.key(relation))
+            for side in (u'source_', u'target_'):
+                if artist_identity(relation, side) == old:
+                    setattr(relation, side + u'mbid', mbid)
+            self.upsert(relation)
+
+    def records(self):
+        """Yield the graph link records of all relations."""
+        for relation in self:
+            yield dict(relation_attrs(relation),
+                       source=artist_identity(relation, u'source_'),
+                       target=artist_identity(relation, u'target_'))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Count last.fm requests of a crawl level with a cold and a warm cache.
+
+Uses the fake last.fm of ``bench_concurrency`` and a temporary response
+cache. Run with::
+
+    $ python benchmarks/bench_cache.py [ARTISTS]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_concurrency import FakeClient
+
+import beetsplug.similarity as similarity
+
+
+def run(plugin, frontier):
+    """Fetch url and similar artists of frontier, return (s, requests)."""
+    similarity.LASTFM_CLIENT = FakeClient(0.005)
+    start = time.perf_counter()
+    for _ in plugin.fetch_ordered(plugin.fetch_url, frontier):
+        pass
+    for _ in plugin.fetch_ordered(plugin.fetch_similar, frontier):
+        pass
+    return time.perf_counter() - start, similarity.LASTFM_CLIENT.calls
+
+
+def main(size):
+    frontier = [similarity.ArtistNode(u'mbid-{}'.format(i),
+                                      u'artist {}'.format(i), u'')
+                for i in range(size)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plugin = similarity.SimilarityPlugin()
+        plugin._limiter = similarity.RateLimiter(0)
+        print(u'{:>6} {:>10} {:>10}'.format(u'cache', u'time [s]',
+                                            u'requests'))
+        for label in (u'cold', u'warm'):
+            plugin._cache = similarity.ResponseCache(
+                os.path.join(tmpdir, u'similarity.cache'), 100000,
+                {'url': 3600, 'similar': 3600, 'notfound': 3600})
+            seconds, calls = run(plugin, frontier)
+            plugin._cache.close()
+            print(u'{:>6} {:>10.2f} {:>10}'.format(label, seconds, calls))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Measure last.fm fetch throughput of one crawl level per worker count.
+
+last.fm is replaced by an in-process fake that sleeps for a fixed round
+trip per request, which is where a real crawl spends its wall time. Run
+with::
+
+    $ python benchmarks/bench_concurrency.py [LATENCY_MS]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import sys
+import time
+
+from beets import config
+
+import beetsplug.similarity as similarity
+
+config.read(user=False, defaults=True)
+
+
+class FakeClient(object):
+    """Stand-in for similarity.LastfmClient with a fixed latency."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def request(self, answer):
+        self.calls += 1
+        time.sleep(self.latency)
+        return answer
+
+    def url(self, name):
+        return u'https://www.last.fm/music/' + name.replace(u' ', u'+')
+
+    def similar(self, limit, mbid=None, name=None):
+        name = self.request(mbid or name)
+        return self.url(name), [
+            (u'mbid-{} {}'.format(name, i), u'{} {}'.format(name, i),
+             self.url(u'{} {}'.format(name, i)), 1.0 / (i + 1))
+            for i in range(limit)]
+
+
+def run(workers, rate, frontier, latency):
+    """Fetch a frontier and return (seconds, requests)."""
+    similarity.LASTFM_CLIENT = FakeClient(latency)
+    plugin = similarity.SimilarityPlugin()
+    plugin.config['workers'] = workers
+    plugin._limiter = similarity.RateLimiter(rate, burst=workers)
+    start = time.perf_counter()
+    for _ in plugin.fetch_ordered(plugin.fetch_similar, frontier):
+        pass
+    return time.perf_counter() - start, similarity.LASTFM_CLIENT.calls
+
+
+def main(latency):
+    frontier = [similarity.ArtistNode(u'mbid-{}'.format(i),
+                                      u'artist {}'.format(i), u'')
+                for i in range(20)]
+    print(u'{:>8} {:>10} {:>10} {:>10}'.format(u'workers', u'rate [1/s]',
+                                               u'time [s]', u'req/s'))
+    for workers, rate in ((1, 0), (4, 0), (8, 0), (16, 0), (8, 50)):
+        seconds, calls = run(workers, rate, frontier, latency)
+        print(u'{:>8} {:>10} {:>10.2f} {:>10.1f}'.format(
+            workers, rate or u'-', seconds, calls / seconds))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Measure a whole crawl against a local last.fm and MusicBrainz.
+
+Builds a beets library owning every OWNED-th artist of a synthetic
+similarity graph (see ``fakeapi``), serves the graph from a local HTTP
+server and runs the phases of ``beet similarity`` one after another:
+``collect_artists``, ``get_similar``, ``save_graph`` and
+``import_graph`` into a fresh plugin. Reports wall time, requests the
+server answered, peak RSS and the size of the files in the config dir
+after every phase. Each size runs in a fresh interpreter. Run with::
+
+    $ python benchmarks/bench_crawl.py [--latency MS] [--errors RATE]
+          [--workers N] [--depth N] [--owned N] [--cache]
+          [--max-memory MB] [ARTISTS ...]
+
+Sizes from 1000 up to 100000 artists are reasonable; the default is
+1000 and 10000.
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sizes', metavar='ARTISTS', type=int, nargs='*',
+                        default=[1000, 10000])
+    parser.add_argument('--latency', type=float, default=0,
+                        help='round trip of every request in ms')
+    parser.add_argument('--errors', type=float, default=0,
+                        help='share of requests failing with HTTP 503')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--owned', type=int, default=10,
+                        help='own every OWNED-th artist')
+    parser.add_argument('--format', default='json')
+    parser.add_argument('--cache', action='store_true',
+                        help='use the response cache')
+    parser.add_argument('--wait', type=float, default=0,
+                        help='seconds to wait for MusicBrainz at the end')
+    parser.add_argument('--max-memory', type=float, default=0,
+                        help='spill to disk above this RSS in MB')
+    parser.add_argument('--single', action='store_true',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def peak_rss():
+    """Return the peak RSS of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def file_size(directory):
+    """Return the size of the files in directory in kB."""
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for name in os.listdir(directory)) // 1024
+
+
+def build_library(lib, graph, owned):
+    """Add one item for every owned artist of graph."""
+    from beets.library import Item
+    with lib.transaction():
+        for i in range(0, graph.size, owned):
+            name = graph.name(i)
+            lib.add(Item(title=u'track', artist=name, albumartist=name,
+                         mb_albumartistid=graph.mbid(i)))
+
+
+def run(args, size, directory):
+    """Run the phases of one crawl and print a row for each."""
+    os.environ['BEETSDIR'] = directory
+    from beets import config
+    from beets.library import Library
+    config.read(user=False, defaults=True)
+
+    import beetsplug.similarity as similarity
+    from fakeapi import FakeApi, SyntheticGraph
+
+    graph = SyntheticGraph(size)
+    jsonfile = os.path.join(directory, u'similarity.json')
+
+    def plugin():
+        similarity.G = None
+        instance = similarity.SimilarityPlugin()
+        instance.config['workers'] = args.workers
+        instance._limiter = similarity.RateLimiter(0)
+        instance.config['format'] = args.format
+        instance.config['cache'] = u'similarity.cache' if args.cache else u''
+        instance.config['musicbrainz_wait'] = args.wait
+        instance.config['max_memory'] = args.max_memory
+        instance._journal = similarity.GraphJournal(jsonfile + u'.journal')
+        instance._spillfile = jsonfile + u'.spill'
+        return instance
+
+    with FakeApi(graph, args.latency / 1000, args.errors) as api:
+        similarity.LASTFM_CLIENT = similarity.LastfmClient(u'bench',
+                                                           api.url)
+        api.use_musicbrainz()
+        crawler = plugin()
+        lib = Library(os.path.join(directory, u'library.db'))
+
+        def phase(name, func, *func_args):
+            api.reset()
+            start = time.perf_counter()
+            func(*func_args)
+            seconds = time.perf_counter() - start
+            print(u'{:>8} {:<8} {:>9.2f} {:>9} {:>9} {:>10}'.format(
+                size, name, seconds, api.total(), peak_rss(),
+                file_size(directory)))
+            sys.stdout.flush()
+
+        def crawl():
+            crawler._cache = crawler.open_cache()
+            crawler._state = similarity.CrawlState(jsonfile + u'.state')
+            crawler.get_similar(lib, args.depth)
+            crawler._state.close()
+            if crawler._cache:
+                crawler._cache.close()
+
+        phase(u'library', build_library, lib, graph, args.owned)
+        phase(u'collect', crawler.collect_artists, lib.items())
+        phase(u'crawl', crawl)
+        phase(u'save', crawler.save_graph, jsonfile)
+        crawler._journal.remove()
+        crawler.close_spill()
+        phase(u'import', plugin().import_graph, jsonfile)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.single:
+        directory = tempfile.mkdtemp()
+        try:
+            run(args, args.sizes[0], directory)
+        finally:
+            shutil.rmtree(directory)
+        return
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(here), here]))
+    print(u'{:>8} {:<8} {:>9} {:>9} {:>9} {:>10}'.format(
+        u'artists', u'phase', u'time [s]', u'requests', u'RSS [MB]',
+        u'files [kB]'))
+    sys.stdout.flush()
+    options = [u'--latency', str(args.latency), u'--errors', str(args.errors),
+               u'--workers', str(args.workers), u'--depth', str(args.depth),
+               u'--owned', str(args.owned), u'--format', args.format,
+               u'--wait', str(args.wait), u'--max-memory',
+               str(args.max_memory)] + ([u'--cache'] if args.cache else [])
+    for size in args.sizes:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               u'--single', str(size)] + options, env=env)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
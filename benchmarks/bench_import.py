@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Measure what loading the plugin adds to the startup of ``beet``.
+
+Imports the plugin and creates it in a fresh interpreter, as beets does
+for every enabled plugin on every command, and lists which heavy
+dependencies got loaded on the way. Run with::
+
+    $ python benchmarks/bench_import.py [RUNS]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import os
+import subprocess
+import sys
+
+SCRIPT = u'''
+import sys, time
+start = time.perf_counter()
+from beets import config
+config.read(user=False, defaults=True)
+base = time.perf_counter()
+import beetsplug.similarity
+beetsplug.similarity.SimilarityPlugin()
+end = time.perf_counter()
+heavy = [m for m in ('matplotlib', 'networkx', 'musicbrainzngs', 'pylast',
+                     'pygraphviz', 'pydotplus') if m in sys.modules]
+print(base - start, end - base, ','.join(heavy) or '-')
+'''
+
+
+def run():
+    """Return (beets seconds, plugin seconds, heavy modules) of one run."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    out = subprocess.check_output([sys.executable, u'-c', SCRIPT], env=env)
+    beets, plugin, heavy = out.decode().split()
+    return float(beets), float(plugin), heavy
+
+
+def main(runs):
+    results = [run() for _ in range(runs)]
+    print(u'{:>10} {:>10}  {}'.format(u'beets [s]', u'plugin [s]',
+                                      u'heavy modules loaded'))
+    for beets, plugin, heavy in results:
+        print(u'{:>10.3f} {:>10.3f}  {}'.format(beets, plugin, heavy))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
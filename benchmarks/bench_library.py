@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Compare library queries and LibraryIndex for ownership checks.
+
+Builds an in-memory beets library with SIZE artists of ten tracks each
+and checks ten similar artists per owned artist, half of them owned,
+the way ``get_similar`` does. Run with::
+
+    $ python benchmarks/bench_library.py [SIZE ...]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import sys
+import time
+
+from beets.library import Item, Library
+
+from beetsplug.similarity import LibraryIndex
+
+
+def make_library(size):
+    """Create a library of size artists with ten items each."""
+    lib = Library(':memory:')
+    with lib.transaction():
+        for i in range(size):
+            for track in range(10):
+                lib.add(Item(artist=u'Artist {}'.format(i),
+                             albumartist=u'Artist {}'.format(i),
+                             mb_albumartistid=u'mbid-{}'.format(i),
+                             title=u'Track {}'.format(track)))
+    return lib
+
+
+def names(size):
+    """Yield the similar artist names a crawl over size artists checks."""
+    for i in range(size):
+        for j in range(10):
+            yield u'artist {}'.format((i * 7 + j * 13) % (size * 2))
+
+
+def main(sizes):
+    print(u'{:>8} {:>10} {:>10} {:>10}'.format(u'artists', u'query [s]',
+                                               u'build [s]', u'index [s]'))
+    for size in sizes:
+        lib = make_library(size)
+        start = time.perf_counter()
+        for name in names(size):
+            len(lib.items('artist:' + name)) > 0
+        query = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = LibraryIndex(lib)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in names(size):
+            index.owns(name)
+        lookup = time.perf_counter() - start
+        print(u'{:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            size, query, build, lookup))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [125, 250, 500])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Measure peak RSS of the crawl bookkeeping for a synthetic graph.
+
+Registers ARTISTS artists, a third of them without an mbid, and ten
+relations per artist (500k for the default 50000 artists) in the
+registries and the relation store, without the networkx graph. Each size
+runs in a fresh interpreter. Run with::
+
+    $ python benchmarks/bench_memory.py [ARTISTS ...]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import os
+import subprocess
+import sys
+
+SCRIPT = u'''
+import random, resource, sys, time
+from beetsplug.similarity import (ArtistNode, ArtistRegistry, Relation,
+                                  RelationStore)
+size = int(sys.argv[1])
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+rnd = random.Random(size)
+owned, foreign = ArtistRegistry(), ArtistRegistry()
+relations = RelationStore()
+nodes = []
+for i in range(size):
+    mbid = u'' if i % 3 == 0 else u'{:08x}-0000-4000-8000-{:012x}'.format(i, i)
+    node = ArtistNode(mbid, u'Artist%20{}'.format(i),
+                      u'https://www.last.fm/music/Artist+{}'.format(i))
+    node['myname'] = u'Artist {}'.format(i)
+    (owned if i % 2 else foreign).append(node)
+    nodes.append(node)
+for source in nodes:
+    for j in rnd.sample(range(size), 10):
+        target = nodes[j]
+        relations.upsert(Relation(source['mbid'], target['mbid'],
+                                  source['lastfmurl'], target['lastfmurl'],
+                                  rnd.random() * 1000))
+seconds = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(len(relations), (peak - base) // 1024, seconds)
+'''
+
+
+def main(sizes):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    print(u'{:>8} {:>10} {:>13} {:>9}'.format(u'artists', u'relations',
+                                              u'peak RSS [MB]', u'time [s]'))
+    for size in sizes:
+        out = subprocess.check_output(
+            [sys.executable, u'-c', SCRIPT, str(size)], env=env)
+        relations, rss, seconds = out.decode().split()
+        print(u'{:>8} {:>10} {:>13} {:>9.2f}'.format(
+            size, relations, rss, float(seconds)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [50000])
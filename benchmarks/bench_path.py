@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Compare k strongest path queries by networkx and by PathFinder.
+
+Uses the synthetic graph of ``bench_storage`` and looks up the 3
+strongest paths between PAIRS random pairs of artists, once with
+``networkx.shortest_simple_paths`` on a graph weighted like PathFinder
+and once through PathFinder with its landmark table, then again from
+its LRU. Run with::
+
+    $ python benchmarks/bench_path.py [ARTISTS [PAIRS]]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import itertools
+import random
+import sys
+import time
+
+import networkx as nx
+
+from bench_storage import make_graph
+
+from beetsplug.similarity import PathFinder, SimilarityIndex
+
+
+def main(size, pairs):
+    nodes, links = make_graph(size)
+    index = SimilarityIndex.from_records(nodes, links)
+    finder = PathFinder(index)
+    rnd = random.Random(1)
+    ids = [node['id'] for node in nodes]
+    queries = [(rnd.choice(ids), rnd.choice(ids)) for _ in range(pairs)]
+
+    G = nx.Graph()
+    G.add_weighted_edges_from((link['source'], link['target'],
+                               finder.cost(link['rate']))
+                              for link in links)
+    start = time.perf_counter()
+    for source, target in queries:
+        list(itertools.islice(nx.shortest_simple_paths(
+            G, source, target, weight='weight'), 3))
+    plain = time.perf_counter() - start
+
+    start = time.perf_counter()
+    finder.table
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    for source, target in queries:
+        finder.paths(source, target, 3)
+    searched = time.perf_counter() - start
+    start = time.perf_counter()
+    for source, target in queries:
+        finder.paths(source, target, 3)
+    cached = time.perf_counter() - start
+
+    print(u'{} artists, {} pairs, k=3'.format(size, pairs))
+    print(u'networkx:   {:.4f} s per pair'.format(plain / pairs))
+    print(u'pathfinder: {:.2f} s to build landmarks, {:.4f} s per pair, '
+          u'{:.6f} s per repeated pair'.format(build, searched / pairs,
+                                               cached / pairs))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Compare similar-artist lookups by node scan and by SimilarityIndex.
+
+Uses the synthetic graph of ``bench_storage`` in a networkx graph and
+looks up the top 10 owned and not owned artists of QUERIES random seeds,
+once the way ``import_similarity`` used to (scan all nodes for the mbid,
+sort all neighbors) and once through the index. Run with::
+
+    $ python benchmarks/bench_query.py [ARTISTS [QUERIES]]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import random
+import sys
+import time
+
+import networkx as nx
+
+from bench_storage import make_graph
+
+from beetsplug.similarity import SimilarityIndex
+
+
+def scan(G, mbid, k):
+    """Look up the neighbors of mbid like the old import_similarity."""
+    for nid, attrs in G.nodes(data=True):
+        if attrs.get('mbid') == mbid:
+            owned, foreign = [], []
+            for neighbor in nx.all_neighbors(G, nid):
+                if G.nodes[neighbor].get('group') == 0:
+                    foreign.append((neighbor, G[nid][neighbor]))
+                else:
+                    owned.append((neighbor, G[nid][neighbor]))
+            return (sorted(owned, key=lambda e: e[1]['rate'],
+                           reverse=True)[:k],
+                    sorted(foreign, key=lambda e: e[1]['rate'],
+                           reverse=True)[:k])
+
+
+def main(size, queries):
+    nodes, links = make_graph(size)
+    G = nx.Graph()
+    G.add_nodes_from((attrs['id'], attrs) for attrs in nodes)
+    G.add_edges_from((link['source'], link['target'], link)
+                     for link in links)
+    seeds = [node['mbid'] for node in random.Random(1).sample(nodes,
+                                                              queries)]
+
+    start = time.perf_counter()
+    for mbid in seeds:
+        scan(G, mbid, 10)
+    scanned = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = SimilarityIndex.from_graph(G)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    for mbid in seeds:
+        index.top_similar(mbid, 10, owned=True)
+        index.top_similar(mbid, 10, owned=False)
+    indexed = time.perf_counter() - start
+    start = time.perf_counter()
+    for mbid in seeds:
+        index.top_similar(mbid, 10, owned=True)
+        index.top_similar(mbid, 10, owned=False)
+    repeated = time.perf_counter() - start
+
+    print(u'{} artists, {} queries'.format(size, queries))
+    print(u'scan:  {:.4f} s per query'.format(scanned / queries))
+    print(u'index: {:.2f} s to build, {:.6f} s per first query, '
+          u'{:.6f} s per repeated query'.format(build, indexed / queries,
+                                                repeated / queries))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100)
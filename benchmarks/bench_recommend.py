@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Time recommendations for a seed set on a synthetic graph.
+
+Uses the synthetic graph of ``bench_storage`` and scores all not owned
+artists against SEEDS owned ones, in every mode of ``Recommender`` and,
+for comparison, with a Python loop summing rates over the neighbors of
+every seed. Run with::
+
+    $ python benchmarks/bench_recommend.py [ARTISTS [SEEDS]]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_storage import make_graph
+
+from beetsplug.similarity import Recommender, SimilarityIndex
+
+
+def loop(index, seeds):
+    """Sum rates to the seeds over the neighbors of every seed."""
+    scores = {}
+    for seed in seeds:
+        for neighbor, rate in index.top_similar(seed, owned=False):
+            scores[neighbor] = scores.get(neighbor, 0) + rate
+    return sorted(scores.items(), key=lambda e: -e[1])[:20]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main(size, count):
+    nodes, links = make_graph(size)
+    owned = [node['mbid'] for node in nodes if node['group'] == 1]
+    seeds = random.Random(1).sample(owned, count)
+
+    start = time.perf_counter()
+    recommender = Recommender.from_records(nodes, links)
+    build = time.perf_counter() - start
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cachefile = os.path.join(tmpdir, u'graph.matrix.npz')
+        recommender.save(cachefile)
+        start = time.perf_counter()
+        recommender = Recommender.load(cachefile, [])
+        load = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmpdir)
+    positions = recommender.positions(seeds)
+    print(u'{} artists, {} seeds, matrix built in {:.2f} s, loaded from '
+          u'cache in {:.2f} s'.format(size, count, build, load))
+    for mode in Recommender.MODES:
+        print(u'{:>9}: {:.4f} s'.format(mode, timed(
+            recommender.recommend, positions, mode, 20)))
+    index = SimilarityIndex.from_records(nodes, links)
+    print(u'{:>9}: {:.4f} s'.format(u'loop', timed(loop, index, seeds)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Compare list and ArtistRegistry membership checks during a crawl.
+
+Simulates the bookkeeping of ``collect_artists`` and ``get_similar``:
+every owned artist is checked against the owned set, then ten similar
+artists are checked against the foreign set. Run with::
+
+    $ python benchmarks/bench_registry.py [SIZE ...]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import sys
+import time
+
+from beetsplug.similarity import ArtistNode, ArtistRegistry
+
+
+def make_artist(i):
+    """Create a synthetic artist, every third one without an mbid."""
+    mbid = u'' if i % 3 == 0 else u'mbid-{}'.format(i)
+    return ArtistNode(mbid, u'artist {}'.format(i),
+                      u'https://www.last.fm/music/artist+{}'.format(i))
+
+
+def crawl(size, container):
+    """Run the membership checks of a crawl over size owned artists."""
+    owned = container()
+    foreign = container()
+    start = time.perf_counter()
+    for i in range(size):
+        node = make_artist(i)
+        if node not in owned:
+            owned.append(node)
+        for j in range(10):
+            similar = make_artist(size + (i * 7 + j * 13) % (size * 2))
+            if similar not in foreign:
+                foreign.append(similar)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    print(u'{:>8} {:>12} {:>12}'.format(u'artists', u'list [s]',
+                                        u'registry [s]'))
+    for size in sizes:
+        print(u'{:>8} {:>12.3f} {:>12.3f}'.format(
+            size, crawl(size, list), crawl(size, ArtistRegistry)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [500, 1000, 2000, 4000])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Compare saving and loading the graph file as json and binary.
+
+Generates a synthetic graph with ten relations per artist, writes it in
+both formats and reads it back the way ``import_graph`` does. Run
+with::
+
+    $ python benchmarks/bench_storage.py [ARTISTS ...]
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from beetsplug.similarity import (BinaryGraph, read_graph_file,
+                                  write_graph_file)
+
+
+def make_graph(size):
+    """Return node and link records of a synthetic graph."""
+    rnd = random.Random(size)
+    nodes = []
+    for i in range(size):
+        mbid = u'{:08x}-0000-4000-8000-{:012x}'.format(i, i)
+        nodes.append({'id': mbid, 'mbid': mbid, 'group': i % 2,
+                      'checked': i % 2 == 1, 'name': u'Artist%20{}'.format(i),
+                      'lastfmurl': u'https://www.last.fm/music/Artist+{}'
+                                   .format(i),
+                      'myname': u'Artist {}'.format(i)})
+    links = []
+    for i, source in enumerate(nodes):
+        for j in rnd.sample(range(size), 10):
+            if j == i:
+                continue
+            target = nodes[j]
+            links.append({'source': source['id'], 'target': target['id'],
+                          'smbid': source['mbid'], 'tmbid': target['mbid'],
+                          'slastfmurl': source['lastfmurl'],
+                          'tlastfmurl': target['lastfmurl'],
+                          'rate': rnd.randint(0, 1000000) / 1000})
+    return nodes, links
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def neighbors(path):
+    """Open a binary file and sum the rates of the first node."""
+    with BinaryGraph(path) as stored:
+        return sum(stored.rates[stored.indptr[0]:stored.indptr[1]])
+
+
+def main(sizes):
+    tmpdir = tempfile.mkdtemp()
+    print(u'{:>8} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+        u'artists', u'format', u'size [kB]', u'save [s]', u'load [s]',
+        u'open [s]'))
+    try:
+        for size in sizes:
+            nodes, links = make_graph(size)
+            for fmt in ('json', 'binary'):
+                path = os.path.join(tmpdir, u'graph.' + fmt)
+                save, _ = timed(write_graph_file, path, fmt, {}, nodes,
+                                links)
+                load, _ = timed(read_graph_file, path)
+                opened = (u'{:>9.4f}'.format(timed(neighbors, path)[0])
+                          if fmt == 'binary' else u'{:>9}'.format(u'-'))
+                print(u'{:>8} {:>7} {:>10} {:>9.3f} {:>9.3f} {}'.format(
+                    size, fmt, os.path.getsize(path) // 1024, save, load,
+                    opened))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the last.fm and MusicBrainz web services.
+
+``SyntheticGraph`` describes a deterministic similarity graph of any
+size without storing it: artist ``i`` is called ``Artist i``, has an
+mbid derived from ``i`` (unknown to last.fm for every ``hidden``-th
+artist) and ten similar artists drawn from a generator seeded with
+``i``. ``FakeApi`` serves it over HTTP on localhost with a fixed latency
+and error rate, answering the requests of the plugin's last.fm client
+and musicbrainzngs. Used by the benchmarks, e.g.::
+
+    with FakeApi(SyntheticGraph(1000), latency=0.01) as api:
+        similarity.LASTFM_CLIENT = similarity.LastfmClient(u'bench',
+                                                           api.url)
+        api.use_musicbrainz()
+        ...
+        print(api.calls)
+"""
+
+from __future__ import division, absolute_import, print_function
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+MB_NS = u'http://musicbrainz.org/ns/mmd-2.0#'
+NOT_FOUND = json.dumps({u'error': 6, u'message': u'The artist you '
+                             u'supplied could not be found'})
+
+
+class SyntheticGraph(object):
+    """Deterministic similarity graph of size artists."""
+
+    def __init__(self, size, similar=10, hidden=49):
+        self.size = size
+        self.similar = similar
+        self.hidden = hidden
+
+    def name(self, i):
+        return u'Artist {}'.format(i)
+
+    def mbid(self, i):
+        """Return the MusicBrainz id of artist i."""
+        return u'{:08x}-0000-4000-8000-{:012x}'.format(i, i)
+
+    def lastfm_mbid(self, i):
+        """Return the mbid last.fm knows for artist i, maybe u''."""
+        return u'' if i % self.hidden == 0 else self.mbid(i)
+
+    def url(self, i):
+        return u'https://www.last.fm/music/Artist+{}'.format(i)
+
+    def by_name(self, name):
+        """Return the index of the artist called name or None."""
+        match = re.match(r'^artist (\d+)$', name or u'', re.IGNORECASE)
+        if match and int(match.group(1)) < self.size:
+            return int(match.group(1))
+        return None
+
+    def by_mbid(self, mbid):
+        """Return the index of the artist with mbid or None."""
+        try:
+            i = int(mbid.rsplit(u'-', 1)[1], 16)
+        except (AttributeError, IndexError, ValueError):
+            return None
+        return i if i < self.size and self.mbid(i) == mbid else None
+
+    def neighbors(self, i):
+        """Return [(index, match)] of the artists similar to artist i."""
+        rnd = random.Random(i)
+        count = min(self.similar, self.size - 1)
+        others = [j for j in rnd.sample(range(self.size), count + 1)
+                  if j != i][:count]
+        return [(j, round(1.0 - k / (count + 1), 6))
+                for k, j in enumerate(others)]
+
+
+class FakeApi(object):
+    """HTTP server answering last.fm and MusicBrainz requests."""
+
+    def __init__(self, graph, latency=0.0, errors=0.0, seed=0):
+        self.graph = graph
+        self.latency = latency
+        self.errors = errors
+        self.calls = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        """Return the last.fm api url of this server."""
+        return u'http://127.0.0.1:{}/2.0/'.format(self.port)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def use_musicbrainz(self):
+        """Point musicbrainzngs at this server."""
+        import musicbrainzngs
+        musicbrainzngs.set_useragent(u'beets-similarity-bench', u'0')
+        musicbrainzngs.set_hostname(u'127.0.0.1:{}'.format(self.port))
+        musicbrainzngs.set_rate_limit(False)
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def answer(self, endpoint, params):
+        """Return (status, body) for a request, counting it."""
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            failed = self.errors and self._random.random() < self.errors
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 503, u'Service Unavailable'
+        handler = getattr(self, u'answer_' + endpoint.replace(u'.', u'_'),
+                          None)
+        if handler is None:
+            return 400, u'unknown method {}'.format(endpoint)
+        return 200, handler(params)
+
+    def find(self, params):
+        """Return the artist index named by last.fm params or None."""
+        if params.get(u'mbid'):
+            i = self.graph.by_mbid(params[u'mbid'])
+            # last.fm does not know every mbid
+            if i is not None and self.graph.lastfm_mbid(i):
+                return i
+            return None
+        return self.graph.by_name(params.get(u'artist'))
+
+    def answer_artist_getSimilar(self, params):
+        i = self.find(params)
+        if i is None:
+            return NOT_FOUND
+        graph = self.graph
+        limit = int(params.get(u'limit') or graph.similar)
+        return json.dumps({u'similarartists': {
+            u'artist': [{u'name': graph.name(j),
+                         u'mbid': graph.lastfm_mbid(j),
+                         u'match': str(match), u'url': graph.url(j)}
+                        for j, match in graph.neighbors(i)[:limit]],
+            u'@attr': {u'artist': graph.name(i)}}})
+
+    def answer_musicbrainz_artist(self, params):
+        from xml.sax.saxutils import escape
+        match = re.search(r'artist:\((.*)\)', params.get(u'query', u''))
+        name = match.group(1).replace(u'\\', u'') if match else u''
+        i = self.graph.by_name(name)
+        artists = u''
+        if i is not None:
+            artists = (u'<artist id="{}" type="Group" '
+                       u'xmlns:ns2="http://musicbrainz.org/ns/ext#-2.0" '
+                       u'ns2:score="100"><name>{}</name></artist>').format(
+                           self.graph.mbid(i), escape(self.graph.name(i)))
+        return (u'<?xml version="1.0" encoding="UTF-8"?>'
+                u'<metadata xmlns="{}"><artist-list count="{}" offset="0">'
+                u'{}</artist-list></metadata>').format(
+                    MB_NS, 1 if artists else 0, artists)
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in two sends; without TCP_NODELAY
+            # every keep-alive answer waits for a delayed ACK (~40 ms)
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                params = dict((key, values[0]) for key, values in
+                              parse_qs(parts.query).items())
+                if parts.path.startswith(u'/2.0'):
+                    self.reply(*api.answer(params.get(u'method', u''),
+                                           params))
+                    return
+                endpoint = u'musicbrainz.' + parts.path.strip(u'/').split(
+                    u'/')[-1]
+                self.reply(*api.answer(endpoint, params))
+
+            def reply(self, status, body):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json'
+                                 if body.startswith(u'{') else
+                                 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -8,13 +8,175 @@ var link, node;
 // the data - an object with nodes and links
 var graph;
 
+// the data file is picked with ?data=FILE; an index.json written by
+// `beet similarity --export-viz DIR` is shown with precomputed positions
+var params = new URLSearchParams(window.location.search);
+var dataFile = params.get("data") || "demo.json";
+
+// the neighborhood of the artist ?ego=ID is fetched from
+// `beet similarity --serve`, and grows when clicking an artist
+var egoId = params.get("ego");
+var egoRadius = +params.get("radius") || 2, egoLimit = +params.get("limit") || 100;
+
 // load the data
-d3.json("demo.json", function(error, _graph) {
+if (egoId !== null) {
+graph = {nodes: [], links: []};
+initializeDisplay();
+initializeSimulation();
+loadEgo(egoId);
+} else if (/index\.json$/.test(dataFile)) {
+d3.json(dataFile, function(error, index) {
+if (error) throw error;
+initializeLevels(index);
+});
+} else {
+d3.json(dataFile, function(error, _graph) {
 if (error) throw error;
 graph = _graph;
 initializeDisplay();
 initializeSimulation();
 });
+}
+
+
+
+//////////// LEVEL OF DETAIL ////////////
+
+// levels of an export, the shown one and the files loaded so far
+var levels, level = -1, levelData = {}, view, zoomScale = 1;
+
+// draw precomputed positions, without simulation, and switch to a level
+// with more artists when zooming in
+function initializeLevels(index) {
+levels = index;
+view = svg.append("g");
+svg.call(d3.zoom()
+    .scaleExtent([0.5, 64])
+    .on("zoom", function() {
+        view.attr("transform", d3.event.transform);
+        zoomScale = d3.event.transform.k;
+        showLevel(levelFor(zoomScale));
+    }));
+showLevel(0);
+}
+
+// each level has four times the artists, so twice the density
+function levelFor(scale) {
+return Math.max(0, Math.min(levels.levels.length - 1,
+                            Math.floor(Math.log2(scale) + 1)));
+}
+
+function showLevel(wanted) {
+if (wanted == level) return;
+level = wanted;
+var file = levels.levels[wanted].file;
+if (levelData[file]) return drawLevel(levelData[file]);
+var base = dataFile.replace(/index\.json$/, "");
+d3.json(base + file, function(error, data) {
+if (error) throw error;
+data.links.forEach(function(l) {
+    l.source = data.nodes[l.source];
+    l.target = data.nodes[l.target];
+});
+levelData[file] = data;
+if (level == wanted) drawLevel(data);
+});
+}
+
+function drawLevel(data) {
+var scale = Math.min(width, height) / levels.size;
+view.selectAll("*").remove();
+view.append("g")
+    .attr("class", "links")
+.selectAll("line")
+.data(data.links)
+.enter().append("line")
+    .attr("stroke-width", function(d) { return d.rate / 1000; })
+    .attr("x1", function(d) { return d.source.x * scale; })
+    .attr("y1", function(d) { return d.source.y * scale; })
+    .attr("x2", function(d) { return d.target.x * scale; })
+    .attr("y2", function(d) { return d.target.y * scale; });
+view.append("g")
+    .attr("class", "nodes")
+.selectAll("circle")
+.data(data.nodes)
+.enter().append("circle")
+    .attr("r", 2)
+    .attr("fill", function(d) { return d.group == 1 ? "red" : "#555"; })
+    .attr("cx", function(d) { return d.x * scale; })
+    .attr("cy", function(d) { return d.y * scale; })
+.append("title")
+    .text(function(d) { return d.name; });
+}
+
+
+
+//////////// EGO NETWORK ////////////
+
+// nodes and links fetched so far, by id
+var known = {}, knownLinks = {};
+
+// fetch the neighborhood of an artist and add what is new to the graph
+function loadEgo(id) {
+d3.json("artist/" + encodeURIComponent(id) + "/ego?radius=" + egoRadius +
+        "&limit=" + egoLimit, function(error, data) {
+if (error) throw error;
+var center = known[id];
+data.nodes.forEach(function(n) {
+    if (known[n.id]) return;
+    // new artists start around the one they were fetched for
+    if (center) {
+        n.x = center.x + Math.random() * 20 - 10;
+        n.y = center.y + Math.random() * 20 - 10;
+    }
+    known[n.id] = n;
+    graph.nodes.push(n);
+});
+data.links.forEach(function(l) {
+    var key = l.source + "|" + l.target;
+    if (knownLinks[key]) return;
+    knownLinks[key] = l;
+    l.key = key;
+    graph.links.push(l);
+});
+redrawEgo();
+});
+}
+
+function redrawEgo() {
+link = link.data(graph.links, function(d) { return d.key; });
+link = link.enter().append("line").merge(link);
+node = node.data(graph.nodes, function(d) { return d.id; });
+var added = node.enter().append("circle")
+    .attr("fill", function(d) { return d.group == 1 ? "red" : "#555"; })
+    .on("click", function(d) { loadEgo(d.id); })
+    .call(d3.drag()
+        .on("start", dragstarted)
+        .on("drag", dragged)
+        .on("end", dragended));
+added.append("title")
+    .text(function(d) { return d.name; });
+node = added.merge(node);
+simulation.nodes(graph.nodes);
+updateForces();
+updateDisplay();
+}
+
+// list the artists matching the search box, newest answer only
+var searchCount = 0;
+function searchArtists(query) {
+var count = ++searchCount;
+if (!query) return d3.select("#search_results").selectAll("li").remove();
+d3.json("search?q=" + encodeURIComponent(query) + "&limit=20", function(error, data) {
+if (error || count != searchCount) return;
+var items = d3.select("#search_results").selectAll("li")
+    .data(data.artists, function(d) { return d.id; });
+items.exit().remove();
+items.enter().append("li")
+    .text(function(d) { return d.name; })
+    .on("click", function(d) { window.location.search = "?ego=" + encodeURIComponent(d.id); });
+});
+}
 
 
 
@@ -192,11 +354,20 @@ d.fy = null;
 d3.select(window).on("resize", function(){
 width = +svg.node().getBoundingClientRect().width;
 height = +svg.node().getBoundingClientRect().height;
-updateForces();
+if (levels) {
+    level = -1;
+    showLevel(levelFor(zoomScale));
+} else {
+    updateForces();
+}
 });
 
 // convenience function to update everything (run after UI input)
 function updateAll() {
+// exports are drawn at their precomputed positions without forces
+if (levels) {
+    return;
+}
 updateForces();
 updateDisplay();
 }
\ No newline at end of file
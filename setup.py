@@ -19,13 +19,22 @@ setup(
     classifiers=[
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
+    python_requires='>=3.7',
     keywords='beets similarity',
     include_package_data=True,
     packages=['beetsplug'],
-    install_requires=['beets>=1.4.3','pylast','networkx'],
+    install_requires=['beets>=1.4.3','pylast','networkx','musicbrainzngs',
+                      'requests'],
+    extras_require={
+        'graphviz': ['matplotlib','pygraphviz'],
+        'recommend': ['numpy','scipy'],
+        'viz': ['numpy','scipy'],
+    },
 )
 